@@ -4,16 +4,39 @@
 
 import sys
 import getopt
+import os
+import errno
+import select
+import struct
+import fcntl
+import ctypes
+import ctypes.util
 import json
+import re
+import atexit
 import pprint
+import hashlib
+import mmap
+import collections
+import sqlite3
+import cPickle
+import tempfile
 import subprocess
+import resource
 import signal
 import datetime
 import time
+import math
+import random
+import threading
+import Queue
+import functools
+import itertools
+import heapq
+import BaseHTTPServer
 import pika
-import suds
-import requests
-from requests.auth import HTTPBasicAuth
+from pika.adapters import select_connection
+# suds и requests импортируются при первом использовании: рабочему только с exec они не нужны
 
 
 # Репозиторий объектов
@@ -37,6 +60,8 @@ class Options(object):
 
     def __init__(self):
         self._store = {}
+        self.overrides = None  # опции командной строки, имеют приоритет над файлом
+        self.previous = None
         self.log = App().registry().get('log')
         self.sys = App().registry().get('sys')
 
@@ -61,7 +86,76 @@ class Options(object):
     def one_shot(self):
         return 'one_shot' in self._store and self._store['one_shot']
 
+    def delayed_retry(self):
+        return 'delayed_retry' not in self._store or self._store['delayed_retry']
+
+    def concurrency(self):
+        if 'concurrency' in self._store and self._store['concurrency']:
+            return self._store['concurrency']
+        return 1
+
+    # Интервал накопления ACK в секундах. None - подтверждать сразу
+    def ack_interval(self):
+        if 'ack_interval' in self._store:
+            return self._store['ack_interval']
+        return None
+
+    def ack_batch(self):
+        if 'ack_batch' in self._store and self._store['ack_batch']:
+            return self._store['ack_batch']
+        return 100
+
+    def replies(self):
+        return 'replies' not in self._store or self._store['replies']
+
+    def confirms(self):
+        return 'confirms' in self._store and self._store['confirms']
+
+    def workers(self):
+        if 'workers' in self._store and self._store['workers']:
+            return self._store['workers']
+        return 1
+
+    # Сколько секунд ждать завершения обрабатываемых сообщений при остановке
+    def drain_timeout(self):
+        if 'drain_timeout' in self._store and self._store['drain_timeout'] is not None:
+            return self._store['drain_timeout']
+        return 30
+
+    # Переподключаться к брокеру при потере соединения вместо завершения процесса
+    def reconnect(self):
+        return 'reconnect' not in self._store or self._store['reconnect']
+
+    # Наибольшая пауза между попытками переподключения, секунды
+    def reconnect_max_delay(self):
+        if 'reconnect_max_delay' in self._store and self._store['reconnect_max_delay'] is not None:
+            return self._store['reconnect_max_delay']
+        return 60
+
+    # Создать все действия и подготовить их (процессы, аутентификация) до первого сообщения
+    def warmup(self):
+        return 'warmup' in self._store and self._store['warmup']
+
+    def engine(self):
+        if 'engine' in self._store and self._store['engine']:
+            return self._store['engine']
+        return u'blocking'
+
+    # Потоки для действий, не умеющих работать в цикле событий
+    def threads(self):
+        if 'threads' in self._store and self._store['threads']:
+            return self._store['threads']
+        return min(self.concurrency(), 16)
+
+    # Без явного значения prefetch маршрута считается от concurrency (Routes.init)
+    def prefetch(self):
+        if 'prefetch' in self._store and self._store['prefetch'] is not None:
+            return self._store['prefetch']
+        return None
+
     def load(self):
+        if self.overrides is None:
+            self.overrides = dict(self._store)
         if 'config' in self._store:
             fname = self._store['config']
             try:
@@ -90,13 +184,85 @@ class Options(object):
             self.log.show('ERROR: Config filename does not specified\n')
             self.sys.die('config_not_set')
 
+    # Перечитать файл конфигурации. False, если он не прошёл проверку: остаются прежние опции
+    def reload(self):
+        self.previous = self._store
+        self._store = dict(self.overrides)
+        try:
+            self.load()
+            self.validate()
+        except SystemExit:
+            self.rollback()
+            return False
+        return True
+
+    def rollback(self):
+        if self.previous is not None:
+            self._store = self.previous
+            self.previous = None
+
     def validate(self):
-        if not (self.has('queue') and isinstance(self.get('queue'), basestring)):
-            self.log.show('ERROR: queue does not specified\n')
+        if self.has('routes'):
+            if not (isinstance(self.get('routes'), list) and self.get('routes') and
+                    all(Route.correct(r) for r in self.get('routes'))):
+                self.log.show('ERROR: routes must be a non-empty list of routes with queue and action or rules\n')
+                self.sys.die('config_bad')
+        else:
+            if not (self.has('queue') and isinstance(self.get('queue'), basestring)):
+                self.log.show('ERROR: queue does not specified\n')
+                self.sys.die('config_bad')
+            if not (self.has('action') and isinstance(self.get('action'), basestring)) and not self.has('dispatch'):
+                self.log.show('ERROR: Action to run does not specified\n')
+                self.sys.die('config_bad')
+        if self.has('max_priority') and not Route.correct_priority(self.get('max_priority')):
+            self.log.show('ERROR: max_priority must be an integer from 1 to 255\n')
+            self.sys.die('config_bad')
+        if self.has('dispatch') and not Route.correct_dispatch(self.get('dispatch')):
+            self.log.show('ERROR: dispatch must have one of header, routing_key or field and optional map\n')
+            self.sys.die('config_bad')
+        if not Options.positive_int(self.concurrency()):
+            self.log.show('ERROR: concurrency must be a positive integer\n')
+            self.sys.die('config_bad')
+        if self.prefetch() is not None and not (Options.positive_int(self.prefetch()) or self.prefetch() == 0):
+            self.log.show('ERROR: prefetch must be a non-negative integer\n')
+            self.sys.die('config_bad')
+        if self.engine() not in (u'blocking', u'select'):
+            self.log.show("ERROR: Unknown engine '%s'\n" % self.engine())
+            self.sys.die('config_bad')
+        if not Options.positive_int(self.threads()):
+            self.log.show('ERROR: threads must be a positive integer\n')
+            self.sys.die('config_bad')
+        if self.ack_interval() is not None and not (RetryPolicy.number(self.ack_interval()) and self.ack_interval() >= 0):
+            self.log.show('ERROR: ack_interval must be a non-negative number\n')
+            self.sys.die('config_bad')
+        if not (RetryPolicy.number(self.drain_timeout()) and self.drain_timeout() >= 0):
+            self.log.show('ERROR: drain_timeout must be a non-negative number\n')
             self.sys.die('config_bad')
-        if not (self.has('action') and isinstance(self.get('action'), basestring)):
-            self.log.show('ERROR: Action to run does not specified\n')
+        if not (RetryPolicy.number(self.reconnect_max_delay()) and self.reconnect_max_delay() > 0):
+            self.log.show('ERROR: reconnect_max_delay must be a positive number\n')
             self.sys.die('config_bad')
+        if self.has('hosts') and not (isinstance(self.get('hosts'), list) and self.get('hosts') and
+                                      all(isinstance(h, (basestring, dict)) for h in self.get('hosts'))):
+            self.log.show("ERROR: hosts must be a non-empty list of 'host[:port]' or {host, port}\n")
+            self.sys.die('config_bad')
+        if not Options.positive_int(self.ack_batch()):
+            self.log.show('ERROR: ack_batch must be a positive integer\n')
+            self.sys.die('config_bad')
+        if not Options.positive_int(self.workers()):
+            self.log.show('ERROR: workers must be a positive integer\n')
+            self.sys.die('config_bad')
+        if self.workers() > 1 and self.get(u'command_source') == u'console':
+            self.log.show('ERROR: Several workers can not share console input\n')
+            self.sys.die('config_bad')
+        if self.has('cpu_affinity') and not (isinstance(self.get('cpu_affinity'), bool) or
+                                             (isinstance(self.get('cpu_affinity'), list) and
+                                              all(isinstance(c, int) for c in self.get('cpu_affinity')))):
+            self.log.show('ERROR: cpu_affinity must be a boolean or a list of CPU numbers\n')
+            self.sys.die('config_bad')
+
+    @staticmethod
+    def positive_int(value):
+        return isinstance(value, (int, long)) and not isinstance(value, bool) and value > 0
 
 
 # Показывает подсказку по использованию программы, версию и т.д.
@@ -120,6 +286,15 @@ Options:
     -s,     --strict            Die if command is not in config
     -t,     --auto-ack          Always send ACK after command execution
     -b,     --build-queue       Create RabbitMQ queue if it does not exists
+    -n,     --concurrency       Number of messages processed in parallel
+    -p,     --prefetch          RabbitMQ prefetch count (defaults to concurrency times the largest batch size)
+            --sleep-retry       Sleep before NACK instead of delayed requeue
+    -e,     --engine            RabbitMQ engine: blocking (default) or select
+    -w,     --workers           Number of worker processes to fork
+            --cpu-affinity      Pin worker processes to CPUs
+            --confirms          Use publisher confirms for replies and retries
+            --metrics-port      Serve Prometheus metrics on local port
+            --log-format        Log format: text (default) or json
 ''')
 
     def version(self):
@@ -136,6 +311,16 @@ class Log(object):
         self.filename = None
         self.log = None
         self.flush = None
+        self.options = None
+        self.fmt = u'text'
+        self.interval = 0.5
+        self.size = 10000
+        self.queue = None
+        self.thread = None
+        self.registered = False
+        self.local = threading.local()
+
+    LEVEL = re.compile(r'^([A-Z]+): ')
 
     def init(self):
         self.filename = App().registry().get('options').get(u'log_file')
@@ -152,30 +337,181 @@ class Log(object):
                 self.show_err("ERROR: Can't open log file '%s'\nReason: %s" % (self.filename, e))
                 self.sys.die('log_open_error')
 
-    def show(self, string):
-        try:
-            self.log("%s\t%s" % (unicode(datetime.datetime.now()), string))
-            self.flush()
-        except (OSError, IOError) as e:
-            self.show_err("ERROR: Can't write log file '%s'\nReason: %s" % (self.filename, e))
-            self.sys.die('log_write_error')
+    # Настроить фоновую запись после загрузки конфига
+    def setup(self):
+        options = App().registry().get('options')
+        self.options = options
+        if options.has('log_format') and options.get(u'log_format'):
+            self.fmt = options.get(u'log_format')
+        if self.fmt not in (u'text', u'json'):
+            self.show_err("ERROR: Unknown log format '%s'\n" % self.fmt)
+            self.sys.die('config_bad')
+        if options.has('log_flush_interval'):
+            self.interval = options.get(u'log_flush_interval')
+        if options.has('log_queue'):
+            self.size = options.get(u'log_queue')
+        if not (self.interval is None or RetryPolicy.number(self.interval)) or not Options.positive_int(self.size):
+            self.show_err("ERROR: log_flush_interval must be a number and log_queue a positive integer\n")
+            self.sys.die('config_bad')
+        if self.interval:
+            self.start()
+
+    def start(self):
+        self.queue = Queue.Queue(self.size)
+        self.thread = threading.Thread(target=self.writer, name='log-writer')
+        self.thread.daemon = True
+        self.thread.start()
+        if not self.registered:
+            atexit.register(self.close)
+            self.registered = True
+
+    # Поля текущего сообщения для структурированного лога
+    def bind(self, **fields):
+        self.local.context = fields
 
-    def emit(self, string):
+    def unbind(self):
+        self.local.context = None
+
+    # Форматирование откладывается до записи: args подставляются в string в потоке записи
+    def show(self, string, *args):
+        self.put((time.time(), 'show', string, args, getattr(self.local, 'context', None)))
+
+    def emit(self, string, *args):
+        self.put((None, 'emit', string, args, getattr(self.local, 'context', None)))
+
+    def dump(self, data):
+        self.put((time.time(), 'dump', data, (), getattr(self.local, 'context', None)))
+
+    def put(self, entry):
+        if self.queue is None or not self.enqueue(entry):
+            self.write([entry])
+            self.flush_log()
+
+    # Поставить запись в очередь. False - поток записи не работает и очередь не освободится
+    def enqueue(self, entry):
+        while self.thread.is_alive():
+            try:
+                self.queue.put(entry, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    # Фоновая запись пачками со сбросом буфера не чаще interval
+    def writer(self):
+        flushed = time.time()
+        dirty = False
+        while True:
+            try:
+                entry = self.queue.get(timeout=self.interval)
+            except Queue.Empty:
+                if dirty:
+                    self.flush_log()
+                    dirty = False
+                flushed = time.time()
+                continue
+            entries = []
+            while entry is not None:
+                if entry[1] == 'sync':
+                    self.write(entries)
+                    entries = []
+                    self.flush_log()
+                    dirty = False
+                    entry[2].set()
+                else:
+                    entries.append(entry)
+                if len(entries) >= 1000:
+                    break
+                try:
+                    entry = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+            if entries:
+                self.write(entries)
+                dirty = True
+            if dirty and time.time() - flushed >= self.interval:
+                self.flush_log()
+                dirty = False
+                flushed = time.time()
+            if entry is None:
+                if dirty:
+                    self.flush_log()
+                return
+
+    def write(self, entries):
         try:
-            self.log(string)
-            self.flush()
+            self.log(''.join(self.encode(e) for e in entries))
         except (OSError, IOError) as e:
-            self.show_err("ERROR: Can't write log file '%s'\nReason: %s" % (self.filename, e))
-            self.sys.die('log_write_error')
+            self.fail(e)
 
+    # Запись в байтах. Ошибка форматирования одной записи не должна останавливать поток записи
+    def encode(self, entry):
+        try:
+            text = self.render(entry)
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            return text
+        except Exception as e:
+            return 'ERROR: Log entry can not be formatted (%s): %r\n' % (e, entry[2:4])
 
-    def dump(self, data):
+    def flush_log(self):
         try:
-            self.log("%s\n" % pprint.pformat(data))
             self.flush()
         except (OSError, IOError) as e:
-            self.show_err("ERROR: Can't write log file '%s'\nReason: %s" % (self.filename, e))
-            self.sys.die('log_write_error')
+            self.fail(e)
+
+    def fail(self, e):
+        self.show_err("ERROR: Can't write log file '%s'\nReason: %s" % (self.filename, e))
+        if threading.current_thread() is self.thread:
+            # sys.exit в потоке записи не завершит процесс
+            os._exit(App().registry().get('exit_codes')['log_write_error'] & 0xff)
+        self.sys.die('log_write_error')
+
+    def render(self, entry):
+        ts, kind, data, args, context = entry
+        if kind == 'dump':
+            text = "%s\n" % pprint.pformat(data)
+        elif args:
+            text = data % args
+        else:
+            text = data
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if self.fmt == u'json':
+            record = dict(context or {})
+            message = text.strip()
+            level = Log.LEVEL.match(message)
+            if level is not None:
+                record['level'] = level.group(1).lower()
+                message = message[level.end():]
+            elif kind == 'dump':
+                record['level'] = 'debug'
+            record['time'] = datetime.datetime.fromtimestamp(ts if ts is not None else time.time()).isoformat()
+            if isinstance(message, str):
+                message = message.decode('utf-8', 'replace')
+            record['message'] = message
+            return json.dumps(record) + '\n'
+        if kind == 'show':
+            return "%s\t%s" % (datetime.datetime.fromtimestamp(ts), text)
+        return text
+
+    # Дождаться записи всего, что уже в очереди
+    def sync(self):
+        if self.queue is not None:
+            done = threading.Event()
+            if self.enqueue((None, 'sync', done, (), None)):
+                done.wait(5)
+
+    def close(self):
+        if self.queue is not None:
+            if self.enqueue(None):
+                self.thread.join(5)
+            self.queue = None
+
+    # В дочернем процессе после fork поток записи не существует
+    def after_fork(self):
+        if self.queue is not None:
+            self.start()
 
     def format(self, data):
         pprint.pformat(data)
@@ -186,6 +522,139 @@ class Log(object):
     def show_err(self, string):
         self.eout(string)
 
+# Замер длительности этапа обработки
+class MetricsTimer(object):
+
+    def __init__(self, metrics, stage, action):
+        self.metrics = metrics
+        self.stage = stage
+        self.action = action
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.metrics.observe(self.stage, self.action, time.time() - self.started)
+        return False
+
+
+# Счётчики и гистограммы длительности этапов по действиям. Отдаются в формате Prometheus
+class Metrics(object):
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.options = None
+        self.lock = threading.Lock()
+        self.counters = {}    # (имя, действие, метки) -> значение
+        self.histograms = {}  # (этап, действие) -> [счётчики корзин, сумма, количество]
+        self.server = None
+
+    def init(self):
+        self.options = App().registry().get('options')
+
+    def count(self, name, action, n=1, **labels):
+        key = (name, action or '', tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def observe(self, stage, action, seconds):
+        key = (stage, action or '')
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = [[0] * len(Metrics.BUCKETS), 0.0, 0]
+            for n, bound in enumerate(Metrics.BUCKETS):
+                if seconds <= bound:
+                    h[0][n] += 1
+            h[1] += seconds
+            h[2] += 1
+
+    def timer(self, stage, action):
+        return MetricsTimer(self, stage, action)
+
+    # Запустить HTTP сервер и периодический вывод сводки. Вызывается в рабочем процессе
+    def start(self):
+        if self.options.has('metrics_port') and self.options.get(u'metrics_port'):
+            port = self.options.get(u'metrics_port')
+            if App().registry().has('worker_id'):
+                port += App().registry().get('worker_id')
+            host = self.options.get(u'metrics_host') if self.options.has('metrics_host') else '127.0.0.1'
+            metrics = self
+
+            class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+                def do_GET(self):
+                    body = metrics.render()
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+            except (OSError, IOError) as e:
+                self.log.show("WARNING: Can't start metrics server on port %d. Reason: %s\n" % (port, e))
+            else:
+                Metrics.daemon(self.server.serve_forever, 'metrics-http')
+                if self.options.verbose():
+                    self.log.show('INFO: Metrics are served on %s:%d\n' % (host, port))
+        if self.options.has('metrics_interval') and self.options.get(u'metrics_interval'):
+            Metrics.daemon(self.report, 'metrics-log')
+
+    @staticmethod
+    def daemon(target, name):
+        t = threading.Thread(target=target, name=name)
+        t.daemon = True
+        t.start()
+
+    # Периодическая сводка в лог
+    def report(self):
+        while True:
+            time.sleep(self.options.get(u'metrics_interval'))
+            with self.lock:
+                histograms = sorted((k, v[1], v[2]) for k, v in self.histograms.items())
+                counters = sorted(self.counters.items())
+            for (stage, action), total, n in histograms:
+                self.log.show("INFO: Metrics: action '%s' stage '%s' count %d avg %.4fs\n" %
+                              (action, stage, n, total / n))
+            for (name, action, labels), value in counters:
+                self.log.show("INFO: Metrics: action '%s' %s%s %d\n" %
+                              (action, name, ''.join(' %s=%s' % l for l in labels), value))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            names = sorted(set(k[0] for k in self.counters))
+            for name in names:
+                lines.append('# TYPE rabbitworker_%s_total counter' % name)
+                for (n, action, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append('rabbitworker_%s_total{%s} %d' %
+                                     (name, Metrics.labels([('action', action)] + list(labels)), value))
+            lines.append('# TYPE rabbitworker_stage_seconds histogram')
+            for (stage, action), (buckets, total, n) in sorted(self.histograms.items()):
+                labels = [('stage', stage), ('action', action)]
+                for bound, value in zip(Metrics.BUCKETS, buckets):
+                    lines.append('rabbitworker_stage_seconds_bucket{%s} %d' %
+                                 (Metrics.labels(labels + [('le', repr(float(bound)))]), value))
+                lines.append('rabbitworker_stage_seconds_bucket{%s} %d' % (Metrics.labels(labels + [('le', '+Inf')]), n))
+                lines.append('rabbitworker_stage_seconds_sum{%s} %f' % (Metrics.labels(labels), total))
+                lines.append('rabbitworker_stage_seconds_count{%s} %d' % (Metrics.labels(labels), n))
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def labels(pairs):
+        return ','.join('%s="%s"' % (k, unicode(v).encode('utf-8').replace('\\', '\\\\').replace('"', '\\"'))
+                        for k, v in pairs)
+
+
 # Класс системных функций
 class System(object):
 
@@ -207,10 +676,13 @@ class OptionDispatcher(object):
 
     def run(self):
         try:
-            opts, args = getopt.getopt(self.argv[1:], 'Vhvc:dskq:a:1l:tbr:',
+            opts, args = getopt.getopt(self.argv[1:], 'Vhvc:dskq:a:1l:tbr:n:p:e:w:',
                                        ['version', 'help', 'verbose', 'config=', 'debug',
                                         'strict', 'console', 'queue=', 'action=', 'one-shot',
-                                        'log=', 'auto-ack', 'build-queue','source='])
+                                        'log=', 'auto-ack', 'build-queue','source=',
+                                        'concurrency=', 'prefetch=', 'sleep-retry', 'engine=',
+                                        'workers=', 'cpu-affinity', 'confirms',
+                                        'metrics-port=', 'log-format='])
         except getopt.GetoptError:
             self.help.usage()
             self.sys.die('bad_option')
@@ -251,10 +723,35 @@ class OptionDispatcher(object):
                 self.options.set(u'auto_ack', True)
             elif opt in ('-b', '--build-queue'):
                 self.options.set(u'build_queue', True)
+            elif opt in ('-n', '--concurrency'):
+                self.options.set(u'concurrency', self.integer(arg))
+            elif opt in ('-p', '--prefetch'):
+                self.options.set(u'prefetch', self.integer(arg))
+            elif opt == '--sleep-retry':
+                self.options.set(u'delayed_retry', False)
+            elif opt in ('-e', '--engine'):
+                self.options.set(u'engine', arg)
+            elif opt in ('-w', '--workers'):
+                self.options.set(u'workers', self.integer(arg))
+            elif opt == '--cpu-affinity':
+                self.options.set(u'cpu_affinity', True)
+            elif opt == '--confirms':
+                self.options.set(u'confirms', True)
+            elif opt == '--metrics-port':
+                self.options.set(u'metrics_port', self.integer(arg))
+            elif opt == '--log-format':
+                self.options.set(u'log_format', arg)
             else:
                 self.help.usage()
                 self.sys.die('bad_option')
 
+    def integer(self, arg):
+        try:
+            return int(arg)
+        except ValueError:
+            self.help.usage()
+            self.sys.die('bad_option')
+
 
 class Rpc(object):
 
@@ -266,6 +763,13 @@ class Rpc(object):
         self.auth_user = None
         self.auth_pass = None
         self.auth_data = None
+        self.auth_ttl = None
+        self.auth_expires = None
+        self.auth_lock = threading.Lock()
+        self.params = {}
+        self.metrics = App().registry().get('metrics')
+        self.action = None  # имя действия для метрик
+        self.upstream = None
 
     def setup(self, url, user, password):
         self.auth_user = user
@@ -275,24 +779,71 @@ class Rpc(object):
     # Инициализировать параметрами из экшена
     def init(self, params):
         if self.validate(params):
+            self.params = params
+            if u'auth_ttl' in params:
+                self.auth_ttl = params[u'auth_ttl']
+            self.upstream = App().registry().get('upstreams').get(params[u'url'], params)
             self.setup(params[u'url'], params[u'user'], params[u'pass'])
         else:
             self.log.show('ERROR: Bad rpc parameters:\n')
             self.log.dump(params)
-            self.sys.die('bad_config')
+            self.sys.die('config_bad')
 
     def validate(self, params):
         if isinstance(params, dict) and u'url' in params and u'user' in params and u'pass' in params:
-            return True
+            return ((u'auth_ttl' not in params or params[u'auth_ttl'] is None or
+                     RetryPolicy.number(params[u'auth_ttl'])) and
+                    (u'timeout' not in params or RetryPolicy.number(params[u'timeout'])) and
+                    Upstream.correct(params))
         else:
             return False
 
     def auth(self):
         pass
 
+    # Аутентификация с кэшированием на auth_ttl секунд (None - без ограничения)
     def single_auth(self):
+        with self.auth_lock:
+            if self.authenticated():
+                return
+            self.login()
+            if self.auth_ttl is not None:
+                self.auth_expires = time.time() + self.auth_ttl
+
+    def authenticated(self):
+        return (self.auth_data is not None and
+                (self.auth_expires is None or time.time() < self.auth_expires))
+
+    # Сбросить кэш аутентификации, например после отказа сервера
+    def invalidate(self):
+        with self.auth_lock:
+            self.auth_data = None
+            self.auth_expires = None
+
+    def login(self):
         pass
 
+    # Вызов через предохранитель и ограничение частоты сервиса. Исключения, кроме benign, и ответы,
+    # для которых failed(ответ) истинно, считаются неудачными вызовами
+    def guarded(self, call, failed=None, benign=()):
+        if self.upstream is None:
+            return call()
+        started = self.upstream.acquire()
+        try:
+            result = call()
+        except benign:
+            self.upstream.release(started, True)
+            raise
+        except Exception:
+            self.upstream.release(started, False)
+            raise
+        self.upstream.release(started, failed is None or not failed(result))
+        return result
+
+    # Через сколько секунд сервис может стать доступен
+    def remaining(self):
+        return self.upstream.remaining() if self.upstream is not None else 0
+
     def get_response(self, data):
         if not isinstance(data, dict) or u'method' not in data:
             self.log.show('ERROR: RPC request method does not specified\n')
@@ -305,16 +856,38 @@ class JsonRpc(Rpc):
 
     def __init__(self):
         super(JsonRpc, self).__init__()
+        self.session = None
+        self.ids = itertools.count(1)
+
+    # Уникальный id запроса: по нему ответы пакета сопоставляются с запросами
+    def next_id(self):
+        return next(self.ids)
 
     def init(self, params):
         super(JsonRpc, self).init(params)
 
+    def new(self):
+        return JsonRpc()
+
     def setup(self, url, user, password):
         super(JsonRpc, self).setup(url, user, password)
+        import requests
+        import requests.adapters
+        # Сессия держит соединения открытыми между сообщениями
+        pool_size = self.params.get(u'pool_size', max(self.options.concurrency(), 10))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         if self.options.debug():
             self.log.show("DEBUG: JSON RPC initialized for url '%s' user '%s' password '%s'\n" %(self.url, self.auth_user, self.auth_pass))
 
-    def single_auth(self):
+    def validate(self, params):
+        return (super(JsonRpc, self).validate(params) and
+                (u'pool_size' not in params or Options.positive_int(params[u'pool_size'])))
+
+    def login(self):
+        from requests.auth import HTTPBasicAuth
         try:
             self.auth_data = HTTPBasicAuth(self.auth_user, self.auth_pass)
             if self.options.debug():
@@ -323,19 +896,43 @@ class JsonRpc(Rpc):
             self.log.show("ERROR: JSON RPC authentication failed. Reason:\n%s\n" % e)
             self.sys.die('json_rpc_failed')
 
-    def validate(self, params):
-        return super(JsonRpc, self).validate(params)
-
     def get_response(self, data):
         if self.options.debug():
             self.log.show("DEBUG: JSON RPC request:\n")
             self.log.dump(data)
         super(JsonRpc, self).get_response(data)
+        return self.exchange(data)
+
+    # Пакетный запрос JSON-RPC 2.0. Возвращает ответы по id запросов
+    def get_batch_response(self, data):
+        if self.options.debug():
+            self.log.show("DEBUG: JSON RPC batch request:\n")
+            self.log.dump(data)
+        for request in data:
+            super(JsonRpc, self).get_response(request)
+        response = self.exchange(data)
+        if not isinstance(response, list):
+            # Ошибка разбора пакета целиком приходит одним объектом
+            self.log.show("WARNING: JSON RPC batch rejected: %s\n" % response)
+            return {}
+        return dict((r[u'id'], r) for r in response if isinstance(r, dict) and u'id' in r)
+
+    def exchange(self, data):
+        import requests
         try:
-            r = requests.post(self.url, data=json.dumps(data), headers={'content-type':'application/json'}, auth=self.auth_data)
+            r = self.post(data)
+            if r.status_code == 401:
+                # Закэшированная аутентификация отвергнута: обновить и повторить один раз
+                if self.options.verbose():
+                    self.log.show('INFO: JSON RPC authentication rejected. Refreshing\n')
+                self.invalidate()
+                self.single_auth()
+                r = self.post(data)
         except requests.exceptions.ConnectionError as e:
             self.log.show(u"ERROR: JSON RPC request failed. Reason: %s\n" % unicode(e))
-            self.sys.die('rpc_io_error')
+            if self.upstream is None:
+                self.sys.die('rpc_io_error')
+            raise
 
         response = r.json()
         if self.options.debug():
@@ -343,6 +940,13 @@ class JsonRpc(Rpc):
             self.log.dump(response)
         return response
 
+    def post(self, data):
+        with self.metrics.timer('json-rpc', self.action):
+            return self.guarded(lambda: self.session.post(self.url, data=json.dumps(data),
+                                                          headers={'content-type':'application/json'},
+                                                          auth=self.auth_data, timeout=self.params.get(u'timeout')),
+                                failed=lambda r: r.status_code >= 500)
+
 
 # Класс запросов SOAP
 class Soap(Rpc):
@@ -350,14 +954,19 @@ class Soap(Rpc):
     def __init__(self):
         super(Soap, self).__init__()
         self.client = None
+        self.auth_ttl = 300
 
     def init(self, params):
         super(Soap, self).init(params)
 
+    def new(self):
+        return Soap()
+
     def setup(self, url, user, password):
         super(Soap, self).setup(url, user, password)
         try:
-            self.client = suds.client.Client(self.url)
+            # Разобранный WSDL общий для всех действий с этим url, у каждого своя копия клиента
+            self.client = App().registry().get('wsdl_cache').client(self.url).clone()
             if self.options.debug():
                 self.log.show("DEBUG: SOAP initialized for url '%s' user '%s' password '%s'\n" %(self.url, self.auth_user, self.auth_pass))
         except Exception as e:
@@ -368,46 +977,637 @@ class Soap(Rpc):
     def auth(self):
         pass # не нужно каждый раз, только в setup?
 
-    def single_auth(self):
+    # Аутентификация тоже идёт через предохранитель: при недоступном сервисе сообщение откладывается
+    def login(self):
+        import suds
         # FIXME Получить identity
         try:
-            self.auth_data = self.client.service.Authorization('identity', self.auth_user, self.auth_pass)
+            with self.metrics.timer('soap', self.action):
+                self.auth_data = self.guarded(functools.partial(self.client.service.Authorization, 'identity',
+                                                                self.auth_user, self.auth_pass),
+                                              benign=suds.WebFault)
             if (self.auth_data.Status<0):
                 self.log.show("ERROR: SOAP authentication failed. Reason:\n%s\n" % self.auth_data.Description)
                 self.sys.die('soap_badauth')
             if self.options.debug():
                 self.log.show("DEBUG: SOAP authenticated for user '%s' password '%s'\n" %(self.auth_user, self.auth_pass))
+        except (KeyboardInterrupt, UpstreamUnavailable):
+            raise
         except Exception as e:
             self.log.show("ERROR: SOAP authentication failed. Reason:\n%s\n" % e)
-            self.sys.die('soap_failed')
-
+            self.auth_data = None
+            if self.upstream is None:
+                self.sys.die('soap_failed')
+            raise
 
-    def validate(self, params):
-        return super(Soap, self).validate(params)
 
     def get_response(self, data):
         if self.options.debug():
             self.log.show("DEBUG: SOAP request:\n")
             self.log.dump(data)
+        import suds
         super(Soap, self).get_response(data)
         method = data[u'method']
         del data[u'method']
         try:
-            response = self.client.service['RtsWebServiceSoap'][method](data)
+            call = functools.partial(self.client.service['RtsWebServiceSoap'][method], data)
+            try:
+                with self.metrics.timer('soap', self.action):
+                    response = self.guarded(call, benign=suds.WebFault)
+            except suds.WebFault as e:
+                # Возможно, истекла закэшированная аутентификация: обновить и повторить один раз
+                if self.options.verbose():
+                    self.log.show("INFO: SOAP fault '%s'. Refreshing authentication\n" % e)
+                self.invalidate()
+                self.single_auth()
+                with self.metrics.timer('soap', self.action):
+                    response = self.guarded(call, benign=suds.WebFault)
             if self.options.debug():
                 self.log.show("DEBUG: SOAP response:\n")
                 self.log.dump(response)
             return response
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, UpstreamUnavailable):
             raise
         except Exception as e:
             self.log.show("ERROR: SOAP failed. Reason:\n%s\n" % e)
-            self.sys.die('soap_failed')
+            if self.upstream is None:
+                self.sys.die('soap_failed')
+            raise
+
+
+# Кэш клиентов SOAP: один разобранный WSDL на url, на диске между запусками
+class WsdlCache(object):
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.options = App().registry().get('options')
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.location = None
+
+    def init(self):
+        if self.options.has('wsdl_cache'):
+            self.location = self.options.get(u'wsdl_cache')
+        else:
+            self.location = os.path.join(tempfile.gettempdir(), 'rabbitworker-wsdl')
+
+    def client(self, url):
+        import suds.client
+        with self.lock:
+            if url not in self.clients:
+                self.clients[url] = suds.client.Client(url, cache=self.cache(url))
+            elif self.options.debug():
+                self.log.show("DEBUG: SOAP client for '%s' taken from cache\n" % url)
+            return self.clients[url]
+
+    def cache(self, url):
+        import suds.cache
+        if self.location is None or self.options.has('wsdl_cache') and not self.options.get(u'wsdl_cache'):
+            return suds.cache.NoCache()
+        days = self.options.get(u'wsdl_cache_days') if self.options.has('wsdl_cache_days') else 1
+        # У каждого url свой каталог: изменение одного WSDL не сбрасывает кэш остальных
+        location = os.path.join(self.location, hashlib.md5(url).hexdigest())
+        cache = suds.cache.ObjectCache(location=location, days=days)
+        if not self.options.has('wsdl_check') or self.options.get(u'wsdl_check'):
+            self.check(url, cache, location)
+        return cache
+
+    # Сбросить кэш url, если WSDL изменился: ETag/Last-Modified для http, mtime для файлов
+    def check(self, url, cache, location):
+        stamp = self.stamp(url)
+        if stamp is None:
+            return
+        fname = os.path.join(location, 'stamp')
+        try:
+            with open(fname, 'r') as fp:
+                old = fp.read()
+        except (OSError, IOError):
+            old = None
+        if old == stamp:
+            return
+        if old is not None:
+            if self.options.verbose():
+                self.log.show("INFO: WSDL '%s' has changed. Cache cleared\n" % url)
+            cache.clear()
+        try:
+            if not os.path.isdir(location):
+                os.makedirs(location)
+            with open(fname, 'w') as fp:
+                fp.write(stamp)
+        except (OSError, IOError) as e:
+            self.log.show("WARNING: Can't write WSDL cache stamp. Reason: %s\n" % e)
+
+    def stamp(self, url):
+        import requests
+        try:
+            if url.startswith('file://'):
+                return str(os.path.getmtime(url[len('file://'):]))
+            r = requests.head(url, timeout=5, allow_redirects=True)
+            stamp = r.headers.get('etag') or r.headers.get('last-modified')
+            return str(stamp) if stamp else None
+        except (OSError, requests.exceptions.RequestException) as e:
+            if self.options.verbose():
+                self.log.show("INFO: Can't check WSDL '%s' for changes. Reason: %s\n" % (url, e))
+            return None
+
+
+class UpstreamUnavailable(Exception):
+    pass
+
+
+# Предохранитель вызовов внешнего сервиса. При доле неудачных (или медленнее latency) вызовов
+# из последних window не меньше failure_rate вызовы не выполняются open секунд,
+# затем пропускается probes пробных (half-open): успех закрывает предохранитель, ошибка открывает снова
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, name, params):
+        self.log = App().registry().get('log')
+        self.name = name
+        self.failure_rate = params.get(u'failure_rate', 0.5)
+        self.window = params.get(u'window', 20)
+        self.min_calls = params.get(u'min_calls', 5)
+        self.latency = params.get(u'latency')
+        self.open_time = params.get(u'open', 30)
+        self.probes = params.get(u'probes', 1)
+        self.lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.results = collections.deque(maxlen=self.window)
+        self.opened = None
+        self.trials = 0
+
+    # False - вызов выполнять не надо
+    def allow(self):
+        with self.lock:
+            if self.state == CircuitBreaker.OPEN:
+                if time.time() - self.opened < self.open_time:
+                    return False
+                self.state = CircuitBreaker.HALF_OPEN
+                self.trials = 0
+                self.log.show("INFO: Circuit for '%s' is half-open. Probing\n" % self.name)
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if self.trials >= self.probes:
+                    return False
+                self.trials += 1
+            return True
+
+    # Разрешённый вызов не состоялся: вернуть пробу полуоткрытого предохранителя
+    def cancel(self):
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN and self.trials > 0:
+                self.trials -= 1
+
+    def record(self, ok, seconds):
+        if self.latency is not None and seconds > self.latency:
+            ok = False
+        with self.lock:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                if ok:
+                    self.state = CircuitBreaker.CLOSED
+                    self.results.clear()
+                    self.log.show("INFO: Circuit for '%s' is closed\n" % self.name)
+                else:
+                    self.trip()
+            elif self.state == CircuitBreaker.CLOSED:
+                self.results.append(ok)
+                failures = self.results.count(False)
+                if len(self.results) >= self.min_calls and failures >= self.failure_rate * len(self.results):
+                    self.trip()
+
+    def trip(self):
+        self.state = CircuitBreaker.OPEN
+        self.opened = time.time()
+        self.log.show("WARNING: Circuit for '%s' is open for %g s\n" % (self.name, self.open_time))
+
+    # Сколько секунд предохранитель ещё будет открыт
+    def remaining(self):
+        with self.lock:
+            if self.state != CircuitBreaker.OPEN:
+                return 0
+            return max(self.opened + self.open_time - time.time(), 0)
+
+    @staticmethod
+    def correct(params):
+        if not isinstance(params, dict):
+            return False
+        rate = params.get(u'failure_rate', 0.5)
+        return (RetryPolicy.number(rate) and 0 < rate <= 1 and
+                all(Options.positive_int(params[k]) for k in (u'window', u'min_calls', u'probes') if k in params) and
+                all(RetryPolicy.number(params[k]) and params[k] > 0 for k in (u'latency', u'open') if k in params))
+
+
+# Ограничение частоты вызовов: rate в секунду, до burst подряд
+class TokenBucket(object):
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    # Списать токен. Возвращает, сколько секунд подождать перед вызовом, или None, если ждать дольше max_wait
+    def take(self, max_wait):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            wait = (1 - self.tokens) / self.rate if self.tokens < 1 else 0
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+
+# Предохранитель и ограничение частоты одного внешнего сервиса, общие для всех действий с этим url
+class Upstream(object):
+
+    def __init__(self, url, params):
+        self.url = url
+        self.breaker = None
+        self.bucket = None
+        self.max_wait = 1
+        if u'breaker' in params:
+            self.breaker = CircuitBreaker(url, params[u'breaker'])
+        if u'rate_limit' in params:
+            limit = params[u'rate_limit']
+            self.bucket = TokenBucket(limit[u'rate'], limit.get(u'burst', max(limit[u'rate'], 1)))
+            self.max_wait = limit.get(u'max_wait', self.max_wait)
+
+    # Разрешение на вызов. Возвращает время начала вызова для release.
+    # Сначала предохранитель: при открытом токены не тратятся и ожидания нет
+    def acquire(self):
+        if self.breaker is not None and not self.breaker.allow():
+            raise UpstreamUnavailable("Circuit for '%s' is open" % self.url)
+        if self.bucket is not None:
+            wait = self.bucket.take(self.max_wait)
+            if wait is None:
+                if self.breaker is not None:
+                    self.breaker.cancel()
+                raise UpstreamUnavailable("Rate limit for '%s' exceeded" % self.url)
+            if wait:
+                time.sleep(wait)
+        return time.time()
+
+    def release(self, started, ok):
+        if self.breaker is not None:
+            self.breaker.record(ok, time.time() - started)
+
+    # Через сколько секунд имеет смысл повторить вызов
+    def remaining(self):
+        if self.breaker is not None:
+            return self.breaker.remaining()
+        return 0
+
+    @staticmethod
+    def correct(params):
+        if u'breaker' in params and not CircuitBreaker.correct(params[u'breaker']):
+            return False
+        if u'rate_limit' in params:
+            limit = params[u'rate_limit']
+            if not (isinstance(limit, dict) and RetryPolicy.number(limit.get(u'rate')) and limit[u'rate'] > 0):
+                return False
+            if not all(RetryPolicy.number(limit[k]) and limit[k] >= 0 for k in (u'burst', u'max_wait') if k in limit):
+                return False
+        return True
+
+
+# Внешние сервисы по url
+class Upstreams(object):
+
+    def __init__(self):
+        self.upstreams = {}
+        self.lock = threading.Lock()
+
+    # None, если для сервиса не заданы ни breaker, ни rate_limit
+    def get(self, url, params):
+        if u'breaker' not in params and u'rate_limit' not in params:
+            return None
+        with self.lock:
+            if url not in self.upstreams:
+                self.upstreams[url] = Upstream(url, params)
+            return self.upstreams[url]
+
+
+# Кэш результатов: LRU в памяти и, если задан path, sqlite на диске (общий для рабочих процессов).
+# Записи живут ttl секунд. Ключ сообщения - message_id (key: message_id) или хэш тела
+class ResultCache(object):
+
+    PURGE_EVERY = 1000
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.sys = App().registry().get('sys')
+        self.options = App().registry().get('options')
+        self.metrics = App().registry().get('metrics')
+        self.enabled = False
+        self.size = 10000
+        self.ttl = 3600
+        self.path = None
+        self.key_source = u'body'
+        self.max_output = 65536  # наибольший вывод, сохраняемый для ответа
+        self.entries = collections.OrderedDict()  # ключ -> (срок, значение)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.db = None
+        self.pid = None
+        self.puts = 0
+
+    def init(self):
+        if not self.options.has('result_cache'):
+            return
+        cfg = self.options.get(u'result_cache')
+        if not (isinstance(cfg, dict)
+                and Options.positive_int(cfg.get(u'size', self.size))
+                and RetryPolicy.number(cfg.get(u'ttl', self.ttl)) and cfg.get(u'ttl', self.ttl) > 0
+                and (cfg.get(u'path') is None or isinstance(cfg.get(u'path'), basestring))
+                and cfg.get(u'key', self.key_source) in (u'body', u'message_id')
+                and Options.positive_int(cfg.get(u'max_output', self.max_output))):
+            self.log.show('ERROR: result_cache must have positive size, ttl and max_output, path and key (body|message_id)\n')
+            self.sys.die('config_bad')
+        self.size = cfg.get(u'size', self.size)
+        self.ttl = cfg.get(u'ttl', self.ttl)
+        self.path = cfg.get(u'path')
+        self.key_source = cfg.get(u'key', self.key_source)
+        self.max_output = cfg.get(u'max_output', self.max_output)
+        self.enabled = True
+        if self.options.verbose():
+            self.log.show('INFO: Result cache: %d entries, ttl %g s, disk %s\n' % (self.size, self.ttl, self.path))
+
+    # message_id сообщения, обрабатываемого в текущем потоке, и нужен ли по нему ответ с выводом
+    def bind(self, message_id, reply=False):
+        self.local.message_id = message_id
+        self.local.reply = reply
+
+    # Значение для кэша: код результата, вывод и признак, что вывод сохранён.
+    # Вывод хранится только для ответа и не больше max_output. None - результат не кэшируется
+    def pack(self, result):
+        code, output = result
+        if not getattr(self.local, 'reply', False) or output is None:
+            return code, None, output is None
+        if len(output) > self.max_output:
+            return None
+        return code, output, True
+
+    # Результат из значения кэша. None - для ответа нужен вывод, а он не сохранён
+    def unpack(self, value):
+        if len(value) == 2:
+            return value
+        code, output, kept = value
+        if not kept and getattr(self.local, 'reply', False):
+            return None
+        return code, output
+
+    # Ключ результата сообщения
+    def message_key(self, action, i):
+        message_id = getattr(self.local, 'message_id', None)
+        if self.key_source == u'message_id' and message_id:
+            return '%s:result:id:%s' % (action, message_id)
+        return self.key(action, u'result', i)
+
+    # Ключ шага действия по содержимому данных
+    def key(self, action, step, data):
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        elif not isinstance(data, (str, mmap.mmap)):
+            data = str(data)
+        # Тело из хранилища хэшируется по отображению, без копии в строку
+        return '%s:%s:%s' % (action, step, hashlib.sha1(data).hexdigest())
+
+    def get(self, key, action):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None and self.path is not None:
+                entry = self.load(key)
+            if entry is not None and entry[0] > now:
+                self.entries[key] = entry
+                self.metrics.count('cache', action, result='hit')
+                return entry[1]
+        self.metrics.count('cache', action, result='miss')
+        return None
+
+    def put(self, key, value):
+        entry = (time.time() + self.ttl, value)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            if self.path is not None:
+                self.store(key, entry)
+
+    # Соединение с базой открывается в каждом процессе заново: после fork старое использовать нельзя
+    def connection(self):
+        if self.db is None or self.pid != os.getpid():
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+            self.pid = os.getpid()
+        return self.db
+
+    def load(self, key):
+        try:
+            row = self.connection().execute('SELECT expires, value FROM results WHERE key = ?', (key,)).fetchone()
+        except sqlite3.Error as e:
+            self.log.show('WARNING: Result cache read failed. Reason: %s\n' % e)
+            return None
+        if row is None:
+            return None
+        return row[0], cPickle.loads(str(row[1]))
+
+    def store(self, key, entry):
+        try:
+            db = self.connection()
+            db.execute('INSERT OR REPLACE INTO results (key, expires, value) VALUES (?, ?, ?)',
+                       (key, entry[0], sqlite3.Binary(cPickle.dumps(entry[1], cPickle.HIGHEST_PROTOCOL))))
+            self.puts += 1
+            if self.puts % ResultCache.PURGE_EVERY == 0:
+                db.execute('DELETE FROM results WHERE expires < ?', (time.time(),))
+            db.commit()
+        except sqlite3.Error as e:
+            self.log.show('WARNING: Result cache write failed. Reason: %s\n' % e)
+
+
+# Хранилище больших тел сообщений (claim check) в каталоге path. Тело не меньше threshold байт
+# сбрасывается в файл, сообщение с заголовком header берёт тело из файла с этим именем.
+# Тело отображается в память, действия exec передают его на stdin без копирования
+class Spool(object):
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.sys = App().registry().get('sys')
+        self.options = App().registry().get('options')
+        self.metrics = App().registry().get('metrics')
+        self.enabled = False
+        self.path = None
+        self.threshold = 1048576  # None - только тела по ссылке
+        self.header = 'x-claim-check'
+        self.delete = True        # удалять файл по ссылке после подтверждения
+
+    def init(self):
+        if not self.options.has('spool'):
+            return
+        cfg = self.options.get(u'spool')
+        if not (isinstance(cfg, dict)
+                and isinstance(cfg.get(u'path'), basestring)
+                and (cfg.get(u'threshold', self.threshold) is None
+                     or Options.positive_int(cfg.get(u'threshold', self.threshold)))
+                and isinstance(cfg.get(u'header', self.header), basestring)
+                and isinstance(cfg.get(u'delete', self.delete), bool)):
+            self.log.show('ERROR: spool must have path, positive threshold, header and delete (true|false)\n')
+            self.sys.die('config_bad')
+        self.path = cfg[u'path'].encode('utf-8')
+        self.threshold = cfg.get(u'threshold', self.threshold)
+        self.header = str(cfg.get(u'header', self.header))
+        self.delete = cfg.get(u'delete', self.delete)
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                self.log.show("ERROR: Can't create spool directory. Reason: %s\n" % e)
+                self.sys.die('config_bad')
+        self.enabled = True
+        if self.options.verbose():
+            self.log.show('INFO: Spool: %s, threshold %s bytes\n' % (self.path, self.threshold))
+
+    # Тело сообщения из хранилища. None - сообщение обрабатывается как есть.
+    # EnvironmentError - файл по ссылке недоступен
+    def claim(self, props, body):
+        if not self.enabled:
+            return None
+        name = props.headers.get(self.header) if props.headers else None
+        if name is not None:
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            # Берётся только имя файла: ссылка не может указывать за пределы каталога
+            path = os.path.join(self.path, os.path.basename(str(name)))
+            with open(path, 'rb') as f:
+                claim = Claim(path, f, reference=True)
+            self.metrics.count('spool', None, result='reference')
+            return claim
+        if self.threshold is None or len(body) < self.threshold:
+            return None
+        try:
+            claim = self.spill(body)
+        except EnvironmentError as e:
+            self.log.show('WARNING: Message body is not spooled. Reason: %s\n' % e)
+            return None
+        self.metrics.count('spool', None, result='spill')
+        return claim
+
+    # Файл удаляется сразу после отображения: память освобождается при закрытии, после падения мусора не остаётся
+    def spill(self, body):
+        fd, path = tempfile.mkstemp(prefix='body.', dir=self.path)
+        try:
+            with os.fdopen(fd, 'w+b') as f:
+                f.write(body)
+                f.flush()
+                return Claim(path, f)
+        finally:
+            os.unlink(path)
+
+    # Сообщение окончательно подтверждено: файл по ссылке больше не нужен
+    def discard(self, claim):
+        if claim is not None and claim.reference and self.delete:
+            try:
+                os.unlink(claim.path)
+            except OSError as e:
+                self.log.show('WARNING: Spool file is not removed. Reason: %s\n' % e)
+
+
+# Тело сообщения в файле хранилища, отображённое в память только для чтения
+class Claim(object):
+
+    def __init__(self, path, f, reference=False):
+        self.path = path
+        self.reference = reference
+        self.size = os.fstat(f.fileno()).st_size
+        # Пустой файл отобразить нельзя
+        self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else ''
+
+    def __len__(self):
+        return self.size
+
+    # Копия тела для действий, которым нужна строка
+    def __str__(self):
+        return self.data[:]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __repr__(self):
+        return "Claim: '%s' %d bytes" % (self.path, self.size)
+
+
+# Политика повторов действия
+class RetryPolicy(object):
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.max_attempts = None
+        self.delay = None
+        self.multiplier = 1
+        self.max_delay = None
+        self.jitter = 0
+
+    # Параметры берутся из секции retry действия, либо из устаревшего delay
+    def init(self, description):
+        if u'retry' in description:
+            retry = description[u'retry']
+            if not isinstance(retry, dict):
+                return False
+            for k in (u'max_attempts', u'delay', u'multiplier', u'max_delay', u'jitter'):
+                if k in retry:
+                    if not RetryPolicy.number(retry[k]) or retry[k] < 0:
+                        self.log.show("ERROR: Bad retry parameter '%s'\n" % k)
+                        return False
+                    setattr(self, k, retry[k])
+            if self.jitter > 1:
+                self.log.show("ERROR: Retry jitter must not be greater than 1\n")
+                return False
+        elif u'delay' in description and RetryPolicy.number(description[u'delay']):
+            self.delay = description[u'delay']
+        return True
+
+    def enabled(self):
+        return self.delay is not None or self.max_attempts is not None
+
+    # attempt - номер неудачной попытки, начиная с 1
+    def exhausted(self, attempt):
+        return self.max_attempts is not None and attempt >= self.max_attempts
+
+    # Задержка перед следующей попыткой в секундах
+    def backoff(self, attempt):
+        if self.delay is None:
+            return 0
+        d = self.delay * (self.multiplier ** (attempt - 1))
+        if self.max_delay is not None:
+            d = min(d, self.max_delay)
+        if self.jitter:
+            d *= 1 + random.uniform(-self.jitter, self.jitter)
+        return d
+
+    # Повтор выполняется источником комманд без блокировки
+    def deferred(self):
+        return App().registry().has('retrier')
+
+    @staticmethod
+    def number(value):
+        return isinstance(value, (int, long, float)) and not isinstance(value, bool)
 
 
 # Базовый класс действия
 class Action(object):
 
+    # Результат: действие временно не может выполниться, сообщение откладывается без учёта попытки
+    DEFERRED = 'deferred'
+    # Действие принимает тело из хранилища как отображение в память, а не строкой
+    streams_input = False
+
     def __init__(self):
         self.log = App().registry().get('log')
         self.sys = App().registry().get('sys')
@@ -417,6 +1617,15 @@ class Action(object):
         self.type = None
         self.params = {}
         self.delay = None
+        self.retry = RetryPolicy()
+        self.metrics = App().registry().get('metrics')
+        self.batch_size = 1
+        self.batch_linger = 0.1
+        self.batch_delimiter = '\n'
+        self.batch_status = u'exit'
+        self.cache = None
+        self.timeout = None
+        self.weight = 1
 
     def init(self, name, description):
         self.name = name
@@ -438,14 +1647,117 @@ class Action(object):
                 (isinstance(self.description[u'delay'],int) or
                 isinstance(self.description[u'delay'],float))):
                     self.delay = self.description[u'delay']
-            return True
+            if u'timeout' in self.description:
+                if not (RetryPolicy.number(self.description[u'timeout']) and self.description[u'timeout'] > 0):
+                    self.log.show("ERROR: Action '%s' timeout must be a positive number\n" % self.name)
+                    return False
+                self.timeout = self.description[u'timeout']
+            # Доля потоков пула при конкуренции с другими действиями
+            if u'weight' in self.description:
+                if not (RetryPolicy.number(self.description[u'weight']) and self.description[u'weight'] > 0):
+                    self.log.show("ERROR: Action '%s' weight must be a positive number\n" % self.name)
+                    return False
+                self.weight = self.description[u'weight']
+            return self.retry.init(self.description) and self.validate_batch() and self.validate_cache()
         else:
             return False
 
+    # cache: true - не выполнять повторно успешно обработанное сообщение и пройденные шаги
+    def validate_cache(self):
+        if not self.description.get(u'cache'):
+            return True
+        cache = App().registry().get('result_cache')
+        if not cache.enabled:
+            self.log.show("ERROR: Action '%s' uses cache but result_cache is not configured\n" % self.name)
+            return False
+        self.cache = cache
+        return True
+
+    # Параметры пакетной обработки: size, linger, delimiter, status (exit|lines)
+    def validate_batch(self):
+        if u'batch' not in self.description:
+            return True
+        batch = self.description[u'batch']
+        if not (isinstance(batch, dict) and u'size' in batch and Options.positive_int(batch[u'size'])):
+            self.log.show("ERROR: Action '%s' batch size must be a positive integer\n" % self.name)
+            return False
+        self.batch_size = batch[u'size']
+        if u'linger' in batch:
+            if not RetryPolicy.number(batch[u'linger']) or batch[u'linger'] < 0:
+                self.log.show("ERROR: Action '%s' batch linger must be a non-negative number\n" % self.name)
+                return False
+            self.batch_linger = batch[u'linger']
+        if u'delimiter' in batch:
+            if not isinstance(batch[u'delimiter'], basestring) or batch[u'delimiter'] == '':
+                self.log.show("ERROR: Action '%s' batch delimiter must be a non-empty string\n" % self.name)
+                return False
+            self.batch_delimiter = batch[u'delimiter'].encode('utf-8')
+        if u'status' in batch:
+            if batch[u'status'] not in (u'exit', u'lines'):
+                self.log.show("ERROR: Action '%s' batch status must be 'exit' or 'lines'\n" % self.name)
+                return False
+            self.batch_status = batch[u'status']
+        if self.options.prefetch() is not None and 0 < self.options.prefetch() < self.batch_size:
+            self.log.show("WARNING: Action '%s' batch size is greater than prefetch\n" % self.name)
+        return True
+
     def run(self, i):
         self.log.show("ERROR: Abstract action '%s' has been run\n" % self.name)
         self.sys.die('action_abstract_run')
 
+    # Выполнить действие. Возвращает код возврата и вывод (None, если действие его не даёт)
+    def call(self, i):
+        return self.run(i), None
+
+    # Выполнить через кэш: успешный результат того же сообщения берётся из кэша
+    def cached_call(self, i):
+        if self.cache is None:
+            return self.call(i)
+        key = self.cache.message_key(self.name, i)
+        value = self.cache.get(key, self.name)
+        result = self.cache.unpack(value) if value is not None else None
+        if result is not None:
+            if self.options.verbose():
+                self.log.show("INFO: Action '%s' result taken from cache\n" % self.name)
+            return result
+        result = self.call(i)
+        if result[0] == 0:
+            value = self.cache.pack(result)
+            if value is not None:
+                self.cache.put(key, value)
+        return result
+
+    # Результат шага step для данных data, сохранённый ранее (None, если его нет)
+    def recall(self, step, data):
+        if self.cache is None:
+            return None
+        return self.cache.get(self.cache.key(self.name, step, data), self.name)
+
+    def remember(self, step, data, value):
+        if self.cache is not None:
+            self.cache.put(self.cache.key(self.name, step, data), value)
+
+    # Выполнить действие над пакетом сообщений. Возвращает список кодов возврата
+    def run_batch(self, inputs):
+        return [self.run(i) for i in inputs]
+
+    # Запуск в цикле событий без блокировки. По завершении вызывается done(код возврата, вывод).
+    # False - действие не поддерживает цикл событий и будет выполнено через run в потоке
+    def start(self, i, loop, done):
+        return False
+
+    # Подготовка до первого сообщения при опции warmup
+    def warmup(self):
+        pass
+
+    # Через сколько секунд повторить отложенное (DEFERRED) сообщение
+    def deferral(self):
+        return 1
+
+    # Действие заменено при перезагрузке конфигурации
+    def close(self):
+        pass
+
     def __repr__(self):
         return "ActionClass: name '%s' type '%s' params '%s'" % (self.name, self.type, self.params)
 
@@ -473,6 +1785,7 @@ class Action(object):
 
     def wait(self):
         if (self.delay is not None
+            and not self.retry.deferred()
             and not self.options.get(u'one_shot')
             and not self.options.get(u'auto_ack')):
                 if self.options.verbose():
@@ -484,11 +1797,16 @@ class Action(object):
 # Действие - запуск внешней программы
 class ExecAction(Action):
 
+    streams_input = True
+
     def __init__(self):
         self.cmd = None
         self.args = []
         self.popen_args = None
         self.input = None
+        self.stream = None
+        self.controls = None
+        self.fast = False  # запуск через posix_spawn
         super(ExecAction, self).__init__()
 
     def init(self, name, description):
@@ -508,26 +1826,144 @@ class ExecAction(Action):
             self.popen_args = [self.cmd] + self.args
             if u'input' in self.params:
                 self.input = self.params[u'input']
-            return True
+                if isinstance(self.input, unicode):
+                    self.input = self.input.encode('utf-8')
+            return self.validate_stream() and self.validate_controls()
         else:
             return False
 
+    # Потоковый вывод: sink (log|file|reply|discard), path, max_output, overflow (truncate|kill)
+    def validate_stream(self):
+        if u'stream' not in self.params:
+            return True
+        stream = self.params[u'stream']
+        if not isinstance(stream, dict):
+            return False
+        self.stream = {
+            u'sink': stream.get(u'sink', u'log'),
+            u'path': stream.get(u'path'),
+            u'max_output': stream.get(u'max_output'),
+            u'overflow': stream.get(u'overflow', u'truncate')
+        }
+        if (self.stream[u'sink'] not in (u'log', u'file', u'reply', u'discard')
+                or (self.stream[u'sink'] == u'file' and not isinstance(self.stream[u'path'], basestring))
+                or not (self.stream[u'max_output'] is None or Options.positive_int(self.stream[u'max_output']))
+                or self.stream[u'overflow'] not in (u'truncate', u'kill')):
+            self.log.show("ERROR: Action '%s' has bad stream parameters\n" % self.name)
+            return False
+        return True
+
     def run(self, i):
+        return self.call(i)[0]
+
+    def call(self, i):
+        if i is None:
+            i = ''
+        return self.communicate([self.input, i])
+
+    # Весь пакет передаётся одному процессу через stdin, сообщения разделены delimiter
+    def run_batch(self, inputs):
+        d = self.batch_delimiter
+        chunks = [self.input]
+        for i in inputs:
+            chunks.append(i)
+            chunks.append(d)
+        returncode, fout = self.communicate(chunks, capture=self.batch_status == u'lines')
+        if self.batch_status == u'lines' and returncode == 0:
+            # Процесс выводит по строке с кодом возврата на каждое сообщение пакета
+            lines = fout.splitlines()
+            results = []
+            for n in range(len(inputs)):
+                try:
+                    results.append(int(lines[n]))
+                except (IndexError, ValueError):
+                    results.append(None)
+            return results
+        return [returncode] * len(inputs)
+
+    # Приёмники stdout и stderr процесса. capture - stdout нужен целиком
+    def sinks(self, capture=False):
+        if self.stream is None:
+            return CaptureSink(), CaptureSink()
+        limit = self.stream[u'max_output']
+        sink = self.stream[u'sink']
+        if capture or sink == u'reply':
+            out = CaptureSink(limit)
+        elif sink == u'log':
+            out = StreamSink(self.log.show_out, limit)
+        elif sink == u'file':
+            out = FileSink(self.stream[u'path'], limit)
+        else:
+            out = OutputSink(limit)
+        return out, StreamSink(self.log.show_err, limit)
+
+    # Ограничения ресурсов, nice, cpu_affinity, env, cwd и способ запуска spawn (posix|fork)
+    def validate_controls(self):
+        if not ProcessControls.correct(self.params):
+            self.log.show("ERROR: Action '%s' has bad process controls\n" % self.name)
+            return False
+        self.controls = ProcessControls(self.params)
+        self.fast = (self.params.get(u'spawn', u'posix') == u'posix' and
+                     SpawnPopen.available(chdir=self.controls.cwd is not None))
+        if self.params.get(u'spawn') == u'posix' and not self.fast:
+            self.log.show("WARNING: Action '%s' can not use posix_spawn here. Using fork\n" % self.name)
+        return True
+
+    # С таймаутом процесс запускается в своей группе, чтобы по истечении убить и его потомков
+    def popen(self, **kwargs):
+        for name in ('stdin', 'stdout', 'stderr'):
+            kwargs.setdefault(name, subprocess.PIPE)
+        group = self.timeout is not None
+        if self.fast:
+            return SpawnPopen(self.popen_args, self.controls, group, **kwargs)
+        if group or self.controls.active():
+            kwargs['preexec_fn'] = functools.partial(self.controls.preexec, group)
+        return subprocess.Popen(self.popen_args, cwd=self.controls.cwd, env=self.controls.environment(), **kwargs)
+
+    # Время действия истекло. Ненулевой код возврата убитого процесса приведёт к NACK или повтору
+    def expire(self, process):
+        if process.returncode is None:
+            self.log.show("WARNING: Action '%s' timed out after %g s. Killing process group %d\n" %
+                          (self.name, self.timeout, process.pid))
+            self.metrics.count('timeouts', self.name)
+            ExecAction.kill(process, group=True)
+
+    @staticmethod
+    def kill(process, group=False):
+        try:
+            if group:
+                os.killpg(process.pid, signal.SIGKILL)
+            else:
+                process.kill()
+        except OSError:
+            pass
+
+    # Запустить процесс с данными на stdin (список частей). Возвращает код возврата и stdout
+    def communicate(self, chunks, capture=False):
+        if self.stream is not None or any(isinstance(c, mmap.mmap) for c in chunks):
+            return self.pump(chunks, capture)
+        i = ''.join(c for c in chunks if c)
         fout = None
         ferr = None
         pid = None
-        if i is None:
-            i = ''
-        i = (self.input if self.input is not None else '') + i
         try:
             if self.options.verbose():
                 self.log.show("INFO: Run action '%s'\n" % self.name)
-            process = subprocess.Popen(self.popen_args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, stdin=subprocess.PIPE)
+            with self.metrics.timer('spawn', self.name):
+                process = self.popen()
             pid = process.pid
             if self.options.verbose():
                 self.log.show("INFO: Action PID: %d\n" % pid)
 
-            fout, ferr = process.communicate(i)
+            timer = None
+            if self.timeout is not None:
+                timer = threading.Timer(self.timeout, self.expire, [process])
+                timer.daemon = True
+                timer.start()
+            with self.metrics.timer('communicate', self.name):
+                fout, ferr = process.communicate(i)
+            if timer is not None:
+                timer.cancel()
             self.log.show_out(str(fout))
             self.log.show_err(str(ferr))
 
@@ -537,22 +1973,720 @@ class ExecAction(Action):
             if process.returncode:
                 self.wait()
 
-            return process.returncode
+            return process.returncode, fout
         except OSError as e:
             self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
             self.wait()
 #            App().registry().get('sys').die('action_unknown')
+            return None, None
 
+    # Потоковый обмен: вывод уходит в приёмники частями, память не зависит от размера вывода.
+    # Тело из хранилища пишется на stdin частями прямо из отображения
+    def pump(self, chunks, capture):
+        try:
+            if self.options.verbose():
+                self.log.show("INFO: Run action '%s'\n" % self.name)
+            with self.metrics.timer('spawn', self.name):
+                process = self.popen(close_fds=True)
+            if self.options.verbose():
+                self.log.show("INFO: Action PID: %d\n" % process.pid)
+        except OSError as e:
+            self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
+            self.wait()
+            return None, None
+        loop = select_connection.IOLoop()
+        result = []
+
+        def done(out, err, returncode):
+            result.append((returncode, out.value(), err.value()))
+            loop.stop()
+
+        out, err = self.sinks(capture)
+        with self.metrics.timer('communicate', self.name):
+            AsyncProcess(loop, process, chunks, out, err, done,
+                         kill=self.stream is not None and self.stream[u'overflow'] == u'kill',
+                         timeout=self.timeout).start()
+            loop.start()
+        loop.close()
+        returncode, fout, ferr = result[0]
+        if self.stream is None:
+            self.log.show_out(str(fout))
+            self.log.show_err(str(ferr))
+        if self.options.verbose():
+            self.log.show('INFO: Return code: %d\n' % returncode)
+        if returncode:
+            self.wait()
+        return returncode, fout
 
-# Действие - публикация на РТС через SOAP
-class RtsAction(Action):
+    def start(self, i, loop, done):
+        if i is None:
+            i = ''
+        try:
+            if self.options.verbose():
+                self.log.show("INFO: Start action '%s'\n" % self.name)
+            with self.metrics.timer('spawn', self.name):
+                process = self.popen(close_fds=True)
+            if self.options.verbose():
+                self.log.show("INFO: Action PID: %d\n" % process.pid)
+        except OSError as e:
+            self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
+            done(None)
+            return True
+        out, err = self.sinks()
+        AsyncProcess(loop, process, [self.input, i], out, err, functools.partial(self.finish, done, time.time()),
+                     kill=self.stream is not None and self.stream[u'overflow'] == u'kill',
+                     timeout=self.timeout).start()
+        return True
+
+    # Завершение процесса, запущенного через start. Ожидание повтора в цикле событий не делается
+    def finish(self, done, started, out, err, returncode):
+        self.metrics.observe('communicate', self.name, time.time() - started)
+        fout = out.value()
+        if self.stream is None:
+            self.log.show_out(str(fout))
+            self.log.show_err(str(err.value()))
+        if self.options.verbose():
+            self.log.show('INFO: Return code: %d\n' % returncode)
+        done(returncode, fout)
+
+
+# Ограничения для процессов действия: limits (cpu, memory, files, processes, file_size), nice,
+# cpu_affinity, env (дополняет окружение рабочего, null удаляет переменную) и cwd
+class ProcessControls(object):
+
+    LIMITS = {
+        u'cpu': resource.RLIMIT_CPU,
+        u'memory': resource.RLIMIT_AS,
+        u'files': resource.RLIMIT_NOFILE,
+        u'processes': resource.RLIMIT_NPROC,
+        u'file_size': resource.RLIMIT_FSIZE
+    }
+    PRIO_PROCESS = 0
+
+    def __init__(self, params):
+        self.limits = dict((ProcessControls.LIMITS[k], v) for k, v in params.get(u'limits', {}).items())
+        self.nice = params.get(u'nice')
+        self.cpus = params.get(u'cpu_affinity')
+        self.env = params.get(u'env')
+        self.cwd = params.get(u'cwd')
+
+    # Нужно ли что-то делать в процессе до exec
+    def active(self):
+        return bool(self.limits) or self.nice is not None or bool(self.cpus)
+
+    # Окружение процесса. None - окружение рабочего без изменений
+    def environment(self):
+        if self.env is None:
+            return None
+        env = dict(os.environ)
+        for k, v in self.env.items():
+            if v is None:
+                env.pop(k.encode('utf-8'), None)
+            else:
+                env[k.encode('utf-8')] = v.encode('utf-8')
+        return env
+
+    # Применить к процессу pid (0 - к текущему)
+    def apply(self, pid):
+        libc = SpawnPopen.libc()
+        for res, value in self.limits.items():
+            limit = (ctypes.c_ulong * 2)(value, value)
+            if libc.prlimit(pid, res, ctypes.byref(limit), None) != 0:
+                ProcessControls.fail()
+        if self.nice is not None and libc.setpriority(ProcessControls.PRIO_PROCESS, pid, self.nice) != 0:
+            ProcessControls.fail()
+        if self.cpus:
+            mask = (ctypes.c_ulong * 16)()
+            for cpu in self.cpus:
+                mask[cpu // 64] |= 1 << (cpu % 64)
+            if libc.sched_setaffinity(pid, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+                ProcessControls.fail()
+
+    # preexec_fn для запуска через fork
+    def preexec(self, group):
+        if group:
+            os.setsid()
+        self.apply(0)
 
-    def __init__(self):
-        self.jsonrpc_params = None
-        self.soap_params = None
-        super(RtsAction, self).__init__()
-        self.jsonrpc = App().registry().get('json-rpc')
-        self.soap = App().registry().get('soap')
+    @staticmethod
+    def fail():
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+    @staticmethod
+    def correct(params):
+        limits = params.get(u'limits', {})
+        if not (isinstance(limits, dict) and
+                all(k in ProcessControls.LIMITS and isinstance(v, (int, long)) and v >= 0 for k, v in limits.items())):
+            return False
+        nice = params.get(u'nice')
+        if nice is not None and not (isinstance(nice, int) and -20 <= nice <= 19):
+            return False
+        cpus = params.get(u'cpu_affinity', [])
+        if not (isinstance(cpus, list) and all(isinstance(c, int) and 0 <= c < 1024 for c in cpus)):
+            return False
+        env = params.get(u'env', {})
+        if not (isinstance(env, dict) and all(v is None or isinstance(v, basestring) for v in env.values())):
+            return False
+        return (isinstance(params.get(u'cwd', u''), basestring) and
+                params.get(u'spawn', u'posix') in (u'posix', u'fork'))
+
+
+# Popen с запуском через posix_spawn: glibc создаёт процесс через vfork, не копируя таблицы страниц,
+# поэтому время запуска не зависит от размера памяти рабочего. Ограничения применяются к pid сразу
+# после запуска, до того как процесс успеет заметно потратить ресурсы
+class SpawnPopen(subprocess.Popen):
+
+    SETPGROUP = 0x02
+    _libc = None
+
+    def __init__(self, args, controls, group, **kwargs):
+        self.controls = controls
+        self.group = group
+        super(SpawnPopen, self).__init__(args, **kwargs)
+
+    @staticmethod
+    def libc():
+        if SpawnPopen._libc is None:
+            SpawnPopen._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        return SpawnPopen._libc
+
+    # Закрыть лишние дескрипторы в потомке без fork можно только через posix_spawn_file_actions_addclosefrom_np
+    @staticmethod
+    def available(chdir=False):
+        try:
+            libc = SpawnPopen.libc()
+        except OSError:
+            return False
+        names = ['posix_spawnp', 'posix_spawn_file_actions_addclosefrom_np', 'prlimit']
+        if chdir:
+            names.append('posix_spawn_file_actions_addchdir_np')
+        return all(hasattr(libc, name) for name in names)
+
+    def _execute_child(self, args, executable, preexec_fn, close_fds, cwd, env, universal_newlines,
+                       startupinfo, creationflags, shell, to_close,
+                       p2cread, p2cwrite, c2pread, c2pwrite, errread, errwrite):
+        libc = SpawnPopen.libc()
+        args = [a.encode('utf-8') if isinstance(a, unicode) else a for a in args]
+        env = self.controls.environment()
+        if env is None:
+            env = os.environ
+        envp = ['%s=%s' % item for item in env.items()]
+        argv = (ctypes.c_char_p * (len(args) + 1))(*(args + [None]))
+        envv = (ctypes.c_char_p * (len(envp) + 1))(*(envp + [None]))
+        # Размер posix_spawn_file_actions_t и posix_spawnattr_t в glibc меньше 512 байт
+        actions = ctypes.create_string_buffer(512)
+        attr = ctypes.create_string_buffer(512)
+        pid = ctypes.c_int()
+        libc.posix_spawn_file_actions_init(actions)
+        libc.posix_spawnattr_init(attr)
+        try:
+            # Потомок получает только stdin, stdout и stderr
+            for fd, target in ((p2cread, 0), (c2pwrite, 1), (errwrite, 2)):
+                if fd is not None:
+                    libc.posix_spawn_file_actions_adddup2(actions, fd, target)
+            libc.posix_spawn_file_actions_addclosefrom_np(actions, 3)
+            if self.controls.cwd is not None:
+                libc.posix_spawn_file_actions_addchdir_np(actions, self.controls.cwd.encode('utf-8'))
+            if self.group:
+                libc.posix_spawnattr_setflags(attr, ctypes.c_short(SpawnPopen.SETPGROUP))
+                libc.posix_spawnattr_setpgroup(attr, 0)
+            error = libc.posix_spawnp(ctypes.byref(pid), args[0], actions, attr, argv, envv)
+        finally:
+            libc.posix_spawn_file_actions_destroy(actions)
+            libc.posix_spawnattr_destroy(attr)
+            for fd, used in ((p2cread, p2cwrite), (c2pwrite, c2pread), (errwrite, errread)):
+                if fd is not None and used is not None:
+                    os.close(fd)
+                    to_close.discard(fd)
+        if error:
+            raise OSError(error, os.strerror(error))
+        self.pid = pid.value
+        self._child_created = True
+        if self.controls.active():
+            try:
+                self.controls.apply(self.pid)
+            except OSError:
+                ExecAction.kill(self)
+                self.wait()
+                raise
+
+
+# Приёмник вывода процесса с ограничением размера. Базовый класс отбрасывает вывод
+class OutputSink(object):
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.size = 0
+        self.overflow = False
+
+    def write(self, chunk):
+        if self.limit is not None and self.size + len(chunk) > self.limit:
+            chunk = chunk[:self.limit - self.size]
+            self.overflow = True
+        self.size += len(chunk)
+        if chunk:
+            self.put(chunk)
+
+    def put(self, chunk):
+        pass
+
+    def value(self):
+        return None
+
+    def close(self):
+        pass
+
+
+# Накопление вывода в памяти
+class CaptureSink(OutputSink):
+
+    def __init__(self, limit=None):
+        super(CaptureSink, self).__init__(limit)
+        self.chunks = []
+
+    def put(self, chunk):
+        self.chunks.append(chunk)
+
+    def value(self):
+        return ''.join(self.chunks)
+
+
+# Передача вывода частями в функцию записи (stdout/stderr программы)
+class StreamSink(OutputSink):
+
+    def __init__(self, write, limit=None):
+        super(StreamSink, self).__init__(limit)
+        self.out = write
+
+    def put(self, chunk):
+        self.out(chunk)
+
+
+# Дозапись вывода в файл
+class FileSink(OutputSink):
+
+    def __init__(self, path, limit=None):
+        super(FileSink, self).__init__(limit)
+        self.path = path
+        self.fp = None
+
+    def put(self, chunk):
+        try:
+            if self.fp is None:
+                self.fp = open(self.path, 'ab')
+            self.fp.write(chunk)
+        except EnvironmentError as e:
+            self.fail(e)
+
+    # Файл недоступен: дальнейший вывод отбрасывается как при переполнении (или процесс убивается при overflow: kill)
+    def fail(self, e):
+        App().registry().get('log').show("WARNING: Can't write output file '%s'. Reason: %s\n" % (self.path, e))
+        self.overflow = True
+        self.limit = self.size
+        self.close()
+
+    def close(self):
+        if self.fp is not None:
+            fp = self.fp
+            self.fp = None
+            try:
+                fp.close()
+            except EnvironmentError as e:
+                self.fail(e)
+
+
+# Обмен с дочерним процессом через неблокирующие каналы в цикле событий pika.
+# stdin подаётся частями без склейки, вывод передаётся в приёмники по мере чтения
+class AsyncProcess(object):
+
+    CHUNK = 65536
+
+    def __init__(self, loop, process, chunks, out, err, done, kill=False, timeout=None):
+        self.loop = loop
+        self.process = process
+        self.chunks = [c for c in chunks if c]
+        self.offset = 0
+        self.done = done
+        self.kill = kill
+        self.files = {}
+        self.sinks = {}
+        self.out = out
+        self.err = err
+        self.timeout = timeout  # процесс с таймаутом запущен в своей группе
+        self.timer = None
+
+    def start(self):
+        p = self.process
+        if self.timeout is not None:
+            self.timer = self.loop.add_timeout(self.timeout, self.expire)
+        for f in (p.stdin, p.stdout, p.stderr):
+            flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFL)
+            fcntl.fcntl(f.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        if self.chunks:
+            self.files[p.stdin.fileno()] = p.stdin
+            self.loop.add_handler(p.stdin.fileno(), self.on_write, select_connection.WRITE)
+        else:
+            p.stdin.close()
+        for f, sink in ((p.stdout, self.out), (p.stderr, self.err)):
+            self.files[f.fileno()] = f
+            self.sinks[f.fileno()] = sink
+            self.loop.add_handler(f.fileno(), self.on_read, select_connection.READ)
+
+    def on_write(self, fd, events):
+        chunk = self.chunks[0]
+        try:
+            self.offset += os.write(fd, buffer(chunk, self.offset, AsyncProcess.CHUNK))
+        except (OSError, IOError) as e:
+            if e.errno == errno.EAGAIN:
+                return
+            if e.errno != errno.EPIPE:
+                raise
+            self.chunks = []
+        if self.chunks and self.offset >= len(chunk):
+            self.chunks.pop(0)
+            self.offset = 0
+        if not self.chunks:
+            self.close(fd)
+
+    def on_read(self, fd, events):
+        try:
+            chunk = os.read(fd, AsyncProcess.CHUNK)
+        except (OSError, IOError) as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        if chunk:
+            sink = self.sinks[fd]
+            sink.write(chunk)
+            if sink.overflow and self.kill:
+                self.terminate()
+        else:
+            self.close(fd)
+
+    # Превышен размер вывода: убить процесс и закрыть каналы, чтобы потомки получили SIGPIPE
+    def terminate(self):
+        ExecAction.kill(self.process, group=self.timeout is not None)
+        for fd in list(self.files):
+            self.close(fd)
+
+    def expire(self):
+        self.timer = None
+        App().registry().get('log').show('WARNING: Process %d timed out after %g s. Killing process group\n' %
+                                         (self.process.pid, self.timeout))
+        self.terminate()
+
+    def close(self, fd):
+        self.loop.remove_handler(fd)
+        self.files.pop(fd).close()
+        if not self.files:
+            self.reap()
+
+    # Каналы закрыты, дождаться завершения процесса без блокировки
+    def reap(self):
+        if self.process.poll() is None:
+            self.loop.add_timeout(0.01, self.reap)
+            return
+        if self.timer is not None:
+            self.loop.remove_timeout(self.timer)
+            self.timer = None
+        self.out.close()
+        self.err.close()
+        if self.out.overflow or self.err.overflow:
+            App().registry().get('log').show('WARNING: Process %d output exceeded limit and was %s\n' %
+                                             (self.process.pid, 'killed' if self.kill else 'truncated'))
+        self.done(self.out, self.err, self.process.returncode)
+
+
+class CoProcessError(Exception):
+    pass
+
+
+# Долгоживущий дочерний процесс, обрабатывающий запросы по протоколу через stdin/stdout
+class CoProcess(object):
+
+    def __init__(self, popen, protocol, timeout):
+        self.popen = popen
+        self.protocol = protocol
+        self.timeout = timeout
+        self.process = None
+        self.buffer = ''
+        self.requests = 0
+        self.last_used = None
+        self.seq = 0
+
+    def start(self):
+        self.process = self.popen(stderr=None, close_fds=True)
+        self.last_used = time.time()
+        return self.process.pid
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    # Выполнить запрос. Возвращает код возврата и вывод
+    def call(self, data):
+        self.requests += 1
+        self.last_used = time.time()
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        try:
+            if self.protocol == u'length':
+                self.process.stdin.write(struct.pack('>I', len(data)) + data)
+                self.process.stdin.flush()
+                code, size = struct.unpack('>iI', self.read(8, deadline))
+                return code, self.read(size, deadline)
+            self.seq += 1
+            response = self.exchange({u'id': self.seq, u'input': data.decode('utf-8')}, deadline)
+            return int(response[u'code']), response.get(u'output', u'').encode('utf-8')
+        except (IOError, OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            raise CoProcessError(e)
+
+    # Проверка живости: для протокола json - запрос ping
+    def ping(self):
+        if not self.alive():
+            return False
+        if self.protocol != u'json':
+            return True
+        self.seq += 1
+        deadline = time.time() + (self.timeout if self.timeout is not None else 5)
+        try:
+            self.exchange({u'id': self.seq, u'ping': True}, deadline)
+            self.last_used = time.time()
+            return True
+        except (IOError, OSError, ValueError, KeyError, TypeError, CoProcessError):
+            return False
+
+    def exchange(self, request, deadline):
+        self.process.stdin.write(json.dumps(request) + '\n')
+        self.process.stdin.flush()
+        response = json.loads(self.readline(deadline))
+        if not isinstance(response, dict) or response.get(u'id') != request[u'id']:
+            raise CoProcessError('Unexpected response: %r' % response)
+        return response
+
+    def readline(self, deadline):
+        while '\n' not in self.buffer:
+            self.fill(deadline)
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line
+
+    def read(self, size, deadline):
+        while len(self.buffer) < size:
+            self.fill(deadline)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def fill(self, deadline):
+        fd = self.process.stdout.fileno()
+        wait = None if deadline is None else max(deadline - time.time(), 0)
+        if not select.select([fd], [], [], wait)[0]:
+            raise CoProcessError('Timeout')
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            raise CoProcessError('Process closed output')
+        self.buffer += chunk
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.kill()
+                self.process.wait()
+            except OSError:
+                pass
+        self.process = None
+
+
+# Пул долгоживущих процессов действия
+class CoProcessPool(object):
+
+    def __init__(self, action):
+        self.log = App().registry().get('log')
+        self.options = App().registry().get('options')
+        self.action = action
+        self.idle = collections.deque()
+        self.size = 0
+        # Уведомляет ждущих о возврате процесса в пул и об уменьшении size
+        self.cond = threading.Condition()
+        self.closed = False
+
+    # Взять процесс: свободный, новый (если пул не заполнен) или дождаться освобождения.
+    # Ожидание прерывается и при удалении процесса из пула: тогда можно запустить новый
+    def acquire(self):
+        while True:
+            with self.cond:
+                while not self.idle and self.size >= self.action.processes:
+                    self.cond.wait()
+                if self.idle:
+                    proc = self.idle.popleft()
+                else:
+                    self.size += 1
+                    proc = None
+            if proc is None:
+                return self.spawn()
+            if self.healthy(proc):
+                return proc
+            self.discard(proc)
+
+    def release(self, proc):
+        if self.closed:
+            self.discard(proc)
+        elif self.action.max_requests is not None and proc.requests >= self.action.max_requests:
+            if self.options.verbose():
+                self.log.show("INFO: Action '%s' process %d recycled after %d request(s)\n" %
+                              (self.action.name, proc.process.pid, proc.requests))
+            self.discard(proc)
+        else:
+            with self.cond:
+                self.idle.append(proc)
+                self.cond.notify()
+
+    # Запустить все процессы пула заранее
+    def warmup(self):
+        procs = []
+        try:
+            while self.size < self.action.processes:
+                procs.append(self.acquire())
+        finally:
+            for proc in procs:
+                self.release(proc)
+
+    # Остановить свободные процессы. Занятые остановятся при возврате в пул
+    def close(self):
+        self.closed = True
+        with self.cond:
+            procs = list(self.idle)
+            self.idle.clear()
+        for proc in procs:
+            self.discard(proc)
+
+    # Процесс упал или нарушил протокол
+    def discard(self, proc):
+        proc.stop()
+        self.shrink()
+
+    # Место в пуле освободилось: ждущий поток может запустить новый процесс
+    def shrink(self):
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def healthy(self, proc):
+        if not proc.alive():
+            self.log.show("WARNING: Action '%s' process has died. Restarting\n" % self.action.name)
+            return False
+        if (self.action.health_interval is not None
+                and time.time() - proc.last_used > self.action.health_interval and not proc.ping()):
+            self.log.show("WARNING: Action '%s' process failed health check. Restarting\n" % self.action.name)
+            return False
+        return True
+
+    def spawn(self):
+        proc = CoProcess(self.action.popen, self.action.protocol, self.action.timeout)
+        try:
+            with self.action.metrics.timer('spawn', self.action.name):
+                pid = proc.start()
+        except OSError:
+            self.shrink()
+            raise
+        if self.options.verbose():
+            self.log.show("INFO: Action '%s' process started with PID %d\n" % (self.action.name, pid))
+        return proc
+
+
+# Действие - обработка сообщений пулом долгоживущих процессов
+class PersistentExecAction(ExecAction):
+
+    streams_input = False
+
+    def __init__(self):
+        super(PersistentExecAction, self).__init__()
+        self.processes = None
+        self.max_requests = None
+        self.protocol = u'json'
+        self.health_interval = 60
+        self.pool = None
+
+    def new(self):
+        return PersistentExecAction()
+
+    def validate(self):
+        if not super(PersistentExecAction, self).validate():
+            return False
+        self.processes = self.params.get(u'processes', self.options.concurrency())
+        self.max_requests = self.params.get(u'max_requests')
+        self.protocol = self.params.get(u'protocol', self.protocol)
+        self.timeout = self.params.get(u'timeout', self.timeout)
+        self.health_interval = self.params.get(u'health_interval', self.health_interval)
+        if (not Options.positive_int(self.processes)
+                or not (self.max_requests is None or Options.positive_int(self.max_requests))
+                or self.protocol not in (u'json', u'length')
+                or not (self.timeout is None or RetryPolicy.number(self.timeout))
+                or not (self.health_interval is None or RetryPolicy.number(self.health_interval))):
+            self.log.show("ERROR: Action '%s' has bad persistent process parameters\n" % self.name)
+            return False
+        self.pool = CoProcessPool(self)
+        return True
+
+    def close(self):
+        self.pool.close()
+
+    def warmup(self):
+        self.pool.warmup()
+
+    def run(self, i):
+        return self.call(i)[0]
+
+    def call(self, i):
+        if i is None:
+            i = ''
+        i = (self.input if self.input is not None else '') + i
+        if self.options.verbose():
+            self.log.show("INFO: Run action '%s'\n" % self.name)
+        if self.protocol == u'json':
+            try:
+                i.decode('utf-8')
+            except UnicodeDecodeError:
+                self.log.show("WARNING: Action '%s' input is not UTF-8. Use length protocol\n" % self.name)
+                return None, None
+        try:
+            proc = self.pool.acquire()
+        except OSError as e:
+            self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
+            self.wait()
+            return None, None
+        try:
+            with self.metrics.timer('communicate', self.name):
+                returncode, fout = proc.call(i)
+        except CoProcessError as e:
+            self.log.show("WARNING: Action '%s' process failed\nERROR: Reason: %s\n" % (self.name, e))
+            self.pool.discard(proc)
+            self.wait()
+            return None, None
+        self.pool.release(proc)
+        self.log.show_out(str(fout))
+        if self.options.verbose():
+            self.log.show('INFO: Return code: %d\n' % returncode)
+        if returncode:
+            self.wait()
+        return returncode, fout
+
+    # Сообщения пакета идут по одному через уже запущенные процессы
+    def run_batch(self, inputs):
+        return [self.run(i) for i in inputs]
+
+    # Обмен с процессом блокирующий, выполняется в пуле потоков
+    def start(self, i, loop, done):
+        return False
+
+
+# Действие - публикация на РТС через SOAP
+class RtsAction(Action):
+
+    def __init__(self):
+        self.jsonrpc_params = None
+        self.soap_params = None
+        super(RtsAction, self).__init__()
+        self.jsonrpc = App().registry().get('json-rpc').new()
+        self.soap = App().registry().get('soap').new()
 
     def init(self, name, description):
         super(RtsAction, self).init(name, description)
@@ -570,6 +2704,8 @@ class RtsAction(Action):
                 and isinstance(self.params[u'soap'], dict)):
             self.jsonrpc_params = self.params[u'json-rpc']
             self.soap_params = self.params[u'soap']
+            self.jsonrpc.action = self.name
+            self.soap.action = self.name
             self.jsonrpc.init(self.jsonrpc_params)
             self.soap.init(self.soap_params)
             return True
@@ -584,73 +2720,838 @@ class RtsAction(Action):
             self.log.show("DEBUG: Action input '%s'\n" % unicode(i))
 
         try:
-            # Запросить номер аукциона
-            self.jsonrpc.single_auth();
-            jr = self.jsonrpc.get_response({u'jsonrpc': u'2.0', u'method': u'ext.лот', u'id': 1, u'params': [i]})
-            rts_id = int(jr[u'result'][u'госзакупки_id'])
-            # SOAP запрос
+            # Запросить номер аукциона, если он не получен при прошлой доставке
+            rts_id = self.recall(u'rts_id', i)
+            if rts_id is None:
+                self.jsonrpc.single_auth();
+                jr = self.jsonrpc.get_response(self.lookup(i))
+                rts_id = int(jr[u'result'][u'госзакупки_id'])
+                self.remember(u'rts_id', i, rts_id)
+        except KeyboardInterrupt:
+            raise
+        except UpstreamUnavailable as e:
+            return self.defer(e)
+        except Exception as e:
+            self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
+            self.wait()
+            return 1
+        return self.bind_auction(rts_id)
+
+    # Пакет: номера аукционов запрашиваются одним пакетным JSON-RPC запросом,
+    # привязка и результат - по каждому сообщению отдельно
+    def run_batch(self, inputs):
+        if self.options.verbose():
+            self.log.show("INFO: Run action '%s' for batch of %d\n" % (self.name, len(inputs)))
+        results = [1] * len(inputs)
+        ids = [self.recall(u'rts_id', i) for i in inputs]
+        pending = dict((n, self.lookup(i)) for n, i in enumerate(inputs) if ids[n] is None)
+        try:
+            if pending:
+                self.jsonrpc.single_auth()
+                responses = self.jsonrpc.get_batch_response(pending.values())
+                for n, request in pending.items():
+                    try:
+                        ids[n] = int(responses[request[u'id']][u'result'][u'госзакупки_id'])
+                        self.remember(u'rts_id', inputs[n], ids[n])
+                    except (KeyError, TypeError, ValueError) as e:
+                        self.log.show("WARNING: Lot lookup for '%s' failed. Reason: %s\n" % (inputs[n], e))
+        except KeyboardInterrupt:
+            raise
+        except UpstreamUnavailable as e:
+            return [self.defer(e) if rts_id is None else self.bind_auction(rts_id) for rts_id in ids]
+        except Exception as e:
+            self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
+            self.wait()
+            return results
+        for n, rts_id in enumerate(ids):
+            if rts_id is not None:
+                results[n] = self.bind_auction(rts_id)
+        return results
+
+    def lookup(self, i):
+        return {u'jsonrpc': u'2.0', u'method': u'ext.лот', u'id': self.jsonrpc.next_id(), u'params': [i]}
+
+    # Привязать аукцион к площадке, если он ещё не привязан. Возвращает код результата
+    def bind_auction(self, rts_id):
+        try:
+            if self.recall(u'bound', rts_id) is not None:
+                if self.options.verbose():
+                    self.log.show("INFO: Auction %d is already bound\n" % rts_id)
+                return 0
             self.soap.single_auth()
             sr = self.soap.get_response({'method': 'BindAuctionToIntegrationPlatform', 'uniqueToken': '???token???', 'auctionNumber': rts_id, 'platformId': '???plId???'})
             if sr.Status >= 0:
                 if self.options.verbose():
                     self.log.show("INFO: Success '%s'\n" % sr.Description)
+                self.remember(u'bound', rts_id, True)
+                return 0
             else:
                 if self.options.verbose():
                     self.log.show("INFO: Fail '%s'\n" % sr.Description)
+                return 1
         except KeyboardInterrupt:
             raise
+        except UpstreamUnavailable as e:
+            return self.defer(e)
         except Exception as e:
             self.log.show("WARNING: Action '%s' is terminated abnormally\nERROR: Reason: %s\n" % (self.name, e))
             self.wait()
+            return 1
+
+    def warmup(self):
+        self.jsonrpc.single_auth()
+        self.soap.single_auth()
+
+    # Сервис недоступен: не ждать и не тратить попытку
+    def defer(self, reason):
+        if self.options.verbose():
+            self.log.show("INFO: Action '%s' deferred: %s\n" % (self.name, reason))
+        return Action.DEFERRED
+
+    def deferral(self):
+        return max(self.jsonrpc.remaining(), self.soap.remaining(), 1)
 
-# Хранилище действий
+# Хранилище действий. Действие создаётся при первом обращении: при запуске - только нужные маршрутам
 class Actions(object):
 
+    MAX_BACKOFF = 60
+
     def __init__(self):
         self.log = App().registry().get('log')
         self.sys = App().registry().get('sys')
         self.options = None
+        self.descriptions = {}
         self.actions = {}
+        self.failures = {}  # имя -> (время следующей попытки создания, задержка)
+        self.lock = threading.Lock()
 
     def init(self):
         self.options = App().registry().get('options')
         if self.options.has(u'actions'):
-            actions = self.options.get(u'actions') # Список экшенов в конфиге
-            for k, v in actions.items():
-                self.actions[k] = Action.make(k, v)
-            if self.options.debug():
-                self.log.show('DEBUG: Actions recognized:\n')
-                self.log.dump(self.actions)
+            self.descriptions = dict(self.options.get(u'actions')) # Список экшенов в конфиге
         else:
             self.log.show('ERROR: Config has no actions')
             self.sys.die('config_no_actions')
 
+    # Создать действия маршрутов (все при warmup), чтобы ошибки в них были видны при запуске
+    def prepare(self, names):
+        if self.options.warmup():
+            names = self.names()
+        for name in names:
+            if name in self.descriptions:
+                self.actions[name] = Action.make(name, self.descriptions[name])
+        if self.options.debug():
+            self.log.show('DEBUG: Actions recognized:\n')
+            self.log.dump(self.actions)
+
+    # Подготовить созданные действия в процессе, который будет их выполнять
+    def warmup(self):
+        if not self.options.warmup():
+            return
+        for action in self.actions.values():
+            if action is not None:
+                if self.options.verbose():
+                    self.log.show("INFO: Warming up action '%s'\n" % action.name)
+                action.warmup()
+
+    # Пересоздать созданные действия, описание которых изменилось. Неизменённые сохраняются вместе с пулами процессов
+    def reload(self):
+        if not self.options.has(u'actions'):
+            self.log.show('ERROR: Config has no actions')
+            self.sys.die('config_no_actions')
+        descriptions = self.options.get(u'actions')
+        actions = {}
+        for k, old in self.actions.items():
+            if k not in descriptions:
+                continue
+            if old is not None and old.description == descriptions[k]:
+                actions[k] = old
+            else:
+                actions[k] = Action.make(k, descriptions[k])
+                if self.options.verbose():
+                    self.log.show("INFO: Action '%s' rebuilt\n" % k)
+        replaced = [a for k, a in self.actions.items() if a is not None and actions.get(k) is not a]
+        with self.lock:
+            self.descriptions = dict(descriptions)
+            self.actions = actions
+            self.failures = {}
+        for action in replaced:
+            action.close()
+
     def names(self):
-        return self.actions.keys()
+        return self.descriptions.keys()
+
+    # Уже созданное действие или None, без создания. Для потока соединения и цикла событий:
+    # создание может обращаться к сети (WSDL), это делается в потоке пула через get
+    def built(self, name):
+        return self.actions.get(name)
+
+    # Вес действия без его создания: вызывается под блокировкой очереди пула
+    def weight(self, name):
+        action = self.actions.get(name)
+        if action is not None:
+            return action.weight
+        description = self.descriptions.get(name)
+        weight = description.get(u'weight', 1) if isinstance(description, dict) else 1
+        return weight if RetryPolicy.number(weight) and weight > 0 else 1
+
+    # Вызывается и из потоков пула. Ошибка при создании действия (например, WSDL недоступен) не останавливает
+    # обработку других сообщений: создание повторяется с растущей задержкой, до этого возвращается None
+    def get(self, name):
+        actions = self.actions
+        if name in actions:
+            return actions[name]
+        with self.lock:
+            if name in self.actions or name not in self.descriptions or (self.backoff(name) or 0) > 0:
+                return self.actions.get(name)
+            try:
+                action = Action.make(name, self.descriptions[name])
+            except SystemExit:
+                delay = min(self.failures.get(name, (None, 0.5))[1] * 2, Actions.MAX_BACKOFF)
+                self.failures[name] = (time.time() + delay, delay)
+                self.log.show("ERROR: Action '%s' can not be created. Retrying in %g s\n" % (name, delay))
+                return None
+            self.failures.pop(name, None)
+            self.actions[name] = action
+            if self.options.verbose():
+                self.log.show("INFO: Action '%s' created\n" % name)
+            return action
+
+    # Через сколько секунд можно снова попытаться создать действие. None - создание не проваливалось
+    def backoff(self, name):
+        failure = self.failures.get(name)
+        if failure is None:
+            return None
+        return max(failure[0] - time.time(), 0)
 
     def run(self, name, i):
-        return self.actions[name].run(i)
+        return self.get(name).run(i)
+
+    def call(self, name, i):
+        return self.get(name).call(i)
 
 
 # Класс диспетчера действий
 class CommandRunner(object):
 
+    # Сколько неизвестных имён помнить. Имена приходят в сообщениях, множество не должно расти без предела
+    MISSES = 1024
+
     def __init__(self):
         self.log = App().registry().get('log')
         self.sys = App().registry().get('sys')
         self.options = App().registry().get('options')
         self.actions = App().registry().get('actions')
-        self.command = self.options.get(u'action')
+        self.command = self.options.get(u'action') if self.options.has(u'action') else None
+        self.misses = set()  # неизвестные имена, о которых уже предупредили
 
     def run(self, i):
-        if self.command in self.actions.names():
-            return self.actions.run(self.command, i)
+        return self.call(i)[0]
+
+    # Выполнить действие name (по умолчанию из опции action). Возвращает код возврата и вывод
+    def call(self, i, name=None):
+        if name is None:
+            name = self.command
+        action = self.actions.get(name)
+        if action is not None:
+            return action.cached_call(CommandRunner.body(action, i))
+        if self.actions.backoff(name) is not None:
+            # Действие есть в конфиге, но пока не создаётся: сообщение откладывается
+            if self.options.verbose():
+                self.log.show("INFO: Action '%s' is not available. Message deferred\n" % name)
+            return Action.DEFERRED, None
+        if self.options.die_on_unknown_command():
+            self.log.show("ERROR: Command %s is not recognized\n" % name)
+            self.sys.die('command_unknown')
+        elif name not in self.misses:
+            if len(self.misses) < CommandRunner.MISSES:
+                self.misses.add(name)
+            self.log.show("WARNING: Command %s is not recognized. Skipped\n" % name)
+        elif self.options.verbose():
+            self.log.show("INFO: Command %s is not recognized. Skipped\n" % name)
+        return None, None
+
+    def run_batch(self, name, inputs):
+        action = self.actions.get(name)
+        return action.run_batch([CommandRunner.body(action, i) for i in inputs])
+
+    # Запустить действие в цикле событий. False - нужно выполнить через run.
+    # Действия с кэшем и ещё не созданные выполняются через run: обращение к кэшу на диске и создание блокируют
+    def start(self, i, loop, done, name=None):
+        action = self.actions.built(self.command if name is None else name)
+        return (action is not None and action.cache is None and
+                action.start(CommandRunner.body(action, i), loop, done))
+
+    # Тело из хранилища: отображение для действий, которые его принимают, иначе строка
+    @staticmethod
+    def body(action, i):
+        if isinstance(i, Claim):
+            return i.data if action.streams_input else str(i)
+        return i
+
+
+# Маршрут: очередь со своим каналом, ограничениями и правилами выбора действия
+class Route(object):
+
+    def __init__(self):
+        self.options = App().registry().get('options')
+        self.queue = None
+        self.action = None
+        self.rules = []     # (слова шаблона routing key или None, заголовки, действие)
+        self.dispatch = None
+        self.prefetch = None
+        self.concurrency = 1
+        self.threads = 1
+        self.declare = {}   # параметры queue_declare
+        self.channel = None
+        self.consumer_tag = None
+        self.pool = None
+        self.publisher = None
+        self.retrier = None
+        self.configured = frozenset()  # имена действий из конфига маршрута
+
+    def init(self, description):
+        self.queue = description[u'queue']
+        self.action = description.get(u'action')
+        for rule in description.get(u'rules', []):
+            words = rule[u'routing_key'].split('.') if u'routing_key' in rule else None
+            self.rules.append((words, rule.get(u'headers', {}), rule[u'action']))
+        self.configured = frozenset(name for name in [self.action] + [rule[2] for rule in self.rules]
+                                    if name is not None)
+        if u'dispatch' in description:
+            self.dispatch = Route.dispatcher(description[u'dispatch'])
+        elif self.options.has(u'dispatch'):
+            self.dispatch = Route.dispatcher(self.options.get(u'dispatch'))
+        self.concurrency = description.get(u'concurrency', self.options.concurrency())
+        self.threads = description.get(u'threads', min(self.concurrency, 16))
+        if u'prefetch' in description:
+            self.prefetch = description[u'prefetch']
+        else:
+            # Сообщения выполняются вне потока соединения (в пуле или в цикле событий),
+            # поэтому без ограничения брокер отдал бы рабочему всю очередь
+            self.prefetch = self.concurrency
+        for name in ('durable', 'exclusive'):
+            if name in description:
+                self.declare[name] = description[name]
+            elif self.options.has(name):
+                self.declare[name] = self.options.get(name)
+        # Очередь с приоритетами: брокер выдаёт сообщения с большим priority раньше
+        max_priority = description.get(u'max_priority', self.options.get(u'max_priority')
+                                        if self.options.has(u'max_priority') else None)
+        if max_priority is not None:
+            self.declare['arguments'] = {'x-max-priority': max_priority}
+
+    # Действие для сообщения: имя из самого сообщения, первое подходящее правило, иначе действие маршрута.
+    # Повтор приходит из очереди задержки с другим routing key, исходный сохранён в заголовке
+    def select(self, method, props, body):
+        headers = props.headers or {}
+        routing_key = headers.get(Retrier.ROUTING_KEY, method.routing_key) or ''
+        if self.dispatch is not None:
+            name = self.dispatch(routing_key, headers, body)
+            if name is not None:
+                return name
+        for words, match, action in self.rules:
+            if ((words is None or Route.matches(words, routing_key.split('.'))) and
+                    all(headers.get(k) == v for k, v in match.items())):
+                return action
+        return self.action
+
+    # Имена действий из конфига маршрута. Имена из самих сообщений сюда не входят
+    def names(self):
+        return self.configured
+
+    def __repr__(self):
+        return "Route: queue '%s' action '%s' rules %d prefetch %s concurrency %d" % \
+               (self.queue, self.action, len(self.rules), self.prefetch, self.concurrency)
+
+    # Шаблон как у topic exchange: '*' - ровно одно слово, '#' - ноль или больше слов
+    @staticmethod
+    def matches(pattern, words):
+        if not pattern:
+            return not words
+        if pattern[0] == '#':
+            return any(Route.matches(pattern[1:], words[n:]) for n in range(len(words) + 1))
+        return bool(words) and pattern[0] in ('*', words[0]) and Route.matches(pattern[1:], words[1:])
+
+    # Функция выбора имени действия из сообщения по описанию dispatch, собирается один раз.
+    # Источник имени: header, routing_key (true) или field (путь в JSON теле через точку).
+    # map переводит значение в имя и служит списком разрешённых: значения не из map не выбирают действие
+    @staticmethod
+    def dispatcher(spec):
+        names = spec.get(u'map')
+        if u'header' in spec:
+            header = spec[u'header']
+
+            def value(routing_key, headers, body):
+                return headers.get(header)
+        elif spec.get(u'routing_key'):
+            def value(routing_key, headers, body):
+                return routing_key
         else:
-            if self.options.die_on_unknown_command():
-                self.log.show("ERROR: Command %s is not recognized\n" % self.command)
-                self.sys.die('command_unknown')
+            path = spec[u'field'].split('.')
+
+            def value(routing_key, headers, body):
+                try:
+                    data = json.loads(body)
+                except ValueError:
+                    return None
+                for key in path:
+                    if not isinstance(data, dict):
+                        return None
+                    data = data.get(key)
+                return data
+
+        def select(routing_key, headers, body):
+            name = value(routing_key, headers, body)
+            if not isinstance(name, basestring):
+                return None
+            if names is not None:
+                return names.get(name)
+            return name
+        return select
+
+    @staticmethod
+    def correct_dispatch(spec):
+        if not isinstance(spec, dict):
+            return False
+        sources = [isinstance(spec.get(u'header'), basestring),
+                   spec.get(u'routing_key') is True,
+                   isinstance(spec.get(u'field'), basestring)]
+        names = spec.get(u'map', {})
+        return (sources.count(True) == 1 and isinstance(names, dict) and
+                all(isinstance(v, basestring) for v in names.values()))
+
+    @staticmethod
+    def correct_priority(value):
+        return Options.positive_int(value) and value <= 255
+
+    @staticmethod
+    def correct(description):
+        if not (isinstance(description, dict) and isinstance(description.get(u'queue'), basestring)):
+            return False
+        if u'dispatch' in description and not Route.correct_dispatch(description[u'dispatch']):
+            return False
+        rules = description.get(u'rules', [])
+        if not (isinstance(rules, list) and (isinstance(description.get(u'action'), basestring) or rules or
+                                             u'dispatch' in description)):
+            return False
+        for rule in rules:
+            if not (isinstance(rule, dict) and isinstance(rule.get(u'action'), basestring) and
+                    isinstance(rule.get(u'routing_key', u''), basestring) and
+                    isinstance(rule.get(u'headers', {}), dict)):
+                return False
+        if not all(Options.positive_int(description[k]) for k in (u'concurrency', u'threads') if k in description):
+            return False
+        if u'max_priority' in description and not Route.correct_priority(description[u'max_priority']):
+            return False
+        return u'prefetch' not in description or description[u'prefetch'] == 0 or Options.positive_int(description[u'prefetch'])
+
+
+# Хранилище маршрутов. Без routes в конфиге - один маршрут из опций queue и action
+class Routes(object):
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.options = None
+        self.routes = []
+
+    def init(self):
+        self.options = App().registry().get('options')
+        if self.options.has(u'routes'):
+            descriptions = self.options.get(u'routes')
+        else:
+            description = {u'queue': self.options.get(u'queue'),
+                           u'action': self.options.get(u'action') if self.options.has(u'action') else None,
+                           u'concurrency': self.options.concurrency(),
+                           u'threads': self.options.threads()}
+            if self.options.prefetch() is not None:
+                description[u'prefetch'] = self.options.prefetch()
+            descriptions = [description]
+        actions = App().registry().get('actions').names()
+        batch = Routes.batch_size(App().registry().get('actions').descriptions)
+        for description in descriptions:
+            route = Route()
+            route.init(description)
+            if u'prefetch' not in description:
+                # Каждый поток должен успевать набрать полный пакет
+                route.prefetch *= batch
+            for name in route.names():
+                if name not in actions:
+                    self.log.show("WARNING: Route for queue '%s' refers to unknown action '%s'\n" % (route.queue, name))
+            self.routes.append(route)
+        if self.options.debug():
+            self.log.show('DEBUG: Routes recognized:\n')
+            self.log.dump(self.routes)
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    # Имена действий из маршрутов и правил. Выбираемые по самому сообщению сюда не входят
+    def actions(self):
+        names = set()
+        for route in self.routes:
+            names.update(route.names())
+        return names
+
+    # Наибольший размер пакета среди описаний действий
+    @staticmethod
+    def batch_size(descriptions):
+        sizes = [d[u'batch'][u'size'] for d in descriptions.values()
+                 if isinstance(d, dict) and isinstance(d.get(u'batch'), dict) and
+                 Options.positive_int(d[u'batch'].get(u'size'))]
+        return max(sizes + [1])
+
+    # Есть публикации, ждущие подтверждения брокера
+    def waiting(self):
+        return any(r.publisher is not None and r.publisher.waiting for r in self.routes)
+
+
+# Полученное сообщение и результат его обработки
+class Delivery(object):
+
+    def __init__(self, channel, method, props, body):
+        self.channel = channel
+        self.method = method
+        self.props = props
+        self.body = body    # None, если тело сброшено в хранилище
+        self.claim = None   # тело в хранилище (Claim)
+        self.action = None
+        self.route = None
+        self.result = None
+        self.output = None
+        self.received = time.time()
+        self.started = None
+
+    def priority(self):
+        return self.props.priority or 0
+
+    # Данные для действия
+    def input(self):
+        return self.claim if self.claim is not None else self.body
+
+    # Тело для повторной публикации. Сообщение по ссылке публикуется как было, с тем же заголовком
+    def content(self):
+        return self.body if self.body is not None else str(self.claim)
+
+    def __repr__(self):
+        return "Delivery: tag '%s' result '%s'" % (self.method.delivery_tag, self.result)
+
+
+# Пакет сообщений для одного действия
+class Batch(object):
+
+    def __init__(self, action, route):
+        self.action = action
+        self.route = route
+        self.deliveries = []
+        self.timer = None
+
+    def __len__(self):
+        return len(self.deliveries)
+
+    def priority(self):
+        return max(d.priority() for d in self.deliveries)
+
+    def __repr__(self):
+        return "Batch: action '%s' tags %s" % (self.action, [d.method.delivery_tag for d in self.deliveries])
+
+
+# Очередь пула: сначала сообщения с большим приоритетом, между действиями - взвешенная справедливая очередь.
+# Действие с весом 2 получает вдвое больше освободившихся потоков, чем с весом 1.
+# Переупорядочить можно только уже полученное, поэтому prefetch должен быть больше concurrency
+class Scheduler(object):
+
+    def __init__(self):
+        self.actions = App().registry().get('actions')
+        self.cond = threading.Condition()
+        self.pending = {}  # действие -> куча (-приоритет, номер, сообщение)
+        self.passes = {}   # действие -> виртуальное время следующей выдачи
+        self.clock = 0.0   # виртуальное время последней выдачи
+        self.seq = itertools.count()
+        self.stops = 0     # запросы остановки потоков: выдаются после всех сообщений
+
+    def put(self, delivery):
+        with self.cond:
+            if delivery is None:
+                self.stops += 1
+            else:
+                heap = self.pending.setdefault(delivery.action, [])
+                if not heap:
+                    # Простаивавшее действие не накапливает преимущество
+                    self.passes[delivery.action] = self.clock
+                heapq.heappush(heap, (-delivery.priority(), next(self.seq), delivery))
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while not self.pending and not self.stops:
+                self.cond.wait()
+            if not self.pending:
+                self.stops -= 1
+                return None
+            name = min(self.pending, key=lambda a: (self.pending[a][0][0], self.passes[a]))
+            heap = self.pending[name]
+            delivery = heapq.heappop(heap)[2]
+            self.clock = self.passes[name]
+            if heap:
+                self.passes[name] += 1.0 / self.weight(name)
             else:
-                self.log.show("WARNING: Command %s is not recognized. Skipped\n" % self.command)
+                del self.pending[name]
+                del self.passes[name]
+            return delivery
+
+    def weight(self, name):
+        return self.actions.weight(name)
+
+
+# Пул потоков для выполнения действий вне потока соединения
+class WorkerPool(object):
+
+    def __init__(self, source):
+        self.log = App().registry().get('log')
+        self.sys = App().registry().get('sys')
+        self.options = App().registry().get('options')
+        self.source = source
+        self.queue = None
+        self.threads = []
+
+    def init(self, size, name='worker'):
+        # Очередь не растёт больше prefetch маршрута (он задаётся всегда, кроме явного 0):
+        # брокер не пришлёт больше неподтверждённых сообщений
+        self.queue = Scheduler()
+        for n in range(size):
+            t = threading.Thread(target=self.work, name='%s-%d' % (name, n))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        if self.options.verbose():
+            self.log.show('INFO: Worker pool started with %d thread(s)\n' % size)
+
+    def submit(self, delivery):
+        self.queue.put(delivery)
+
+    def work(self):
+        while True:
+            delivery = self.queue.get()
+            if delivery is None:
+                break
+            if self.source.stale(delivery):
+                # Соединение потеряно, пока сообщение ждало в очереди: брокер доставит его заново,
+                # выполнение сейчас повторило бы действие дважды
+                self.source.threadsafe(functools.partial(self.source.complete, delivery))
+                continue
+            try:
+                self.source.execute(delivery)
+            except SystemExit as e:
+                # sys.die в потоке завершил бы только поток: передать выход в поток соединения
+                self.source.threadsafe(functools.partial(sys.exit, e.code))
+                continue
+            except Exception as e:
+                self.log.show("WARNING: Worker thread failed on %s\nERROR: Reason: %s\n" % (delivery, e))
+                delivery.result = None
+            self.source.threadsafe(functools.partial(self.source.complete, delivery))
+
+    def stop(self):
+        for t in self.threads:
+            self.queue.put(None)
+        self.threads = []
+
+
+# Подтверждения одного канала: неподтверждённые сообщения и накопленные ACK
+class Acks(object):
+
+    def __init__(self, source, channel):
+        self.options = App().registry().get('options')
+        self.source = source
+        self.channel = channel
+        self.unsettled = set()  # delivery_tag сообщений, по которым ещё не принято решение
+        self.pending = []       # delivery_tag, ждущие отправки ACK
+        self.timer = None
+        self.interval = self.options.ack_interval()
+        self.limit = self.options.ack_batch()
+
+    def received(self, tag):
+        self.unsettled.add(tag)
+
+    def ack(self, tag):
+        self.unsettled.discard(tag)
+        if self.interval is None:
+            self.channel.basic_ack(delivery_tag=tag)
+            return
+        self.pending.append(tag)
+        if len(self.pending) >= self.limit:
+            self.flush()
+        elif self.timer is None:
+            self.timer = self.source.connection.add_timeout(self.interval, self.on_timer)
+
+    def nack(self, tag, requeue=True):
+        self.unsettled.discard(tag)
+        self.channel.basic_nack(delivery_tag=tag, requeue=requeue)
+
+    # Одним ACK с multiple, если ниже последнего тега нет других неподтверждённых
+    def ack_all(self, tags):
+        last = max(tags)
+        if self.interval is None and all(t in tags for t in self.unsettled if t <= last):
+            self.unsettled.difference_update(tags)
+            self.channel.basic_ack(delivery_tag=last, multiple=True)
+        else:
+            for t in sorted(tags):
+                self.ack(t)
+
+    def on_timer(self):
+        self.timer = None
+        self.flush()
+
+    # Непрерывный префикс накопленных тегов подтверждается одним ACK, остальные по одному
+    def flush(self):
+        if self.timer is not None:
+            self.source.connection.remove_timeout(self.timer)
+            self.timer = None
+        if not self.pending:
+            return
+        bound = min(self.unsettled) if self.unsettled else None
+        prefix = [t for t in self.pending if bound is None or t < bound]
+        rest = [t for t in self.pending if bound is not None and t > bound]
+        self.pending = []
+        if prefix:
+            self.channel.basic_ack(delivery_tag=max(prefix), multiple=len(prefix) > 1)
+        for t in rest:
+            self.channel.basic_ack(delivery_tag=t)
+
+
+# Публикация ответов и повторов. С confirms исходное сообщение подтверждается после ответа брокера
+class Publisher(object):
+
+    def __init__(self, source):
+        self.log = App().registry().get('log')
+        self.options = App().registry().get('options')
+        self.source = source
+        self.confirms = False
+        self.seq = 0
+        self.waiting = {}  # номер публикации -> then
+
+    def init(self, channel):
+        self.confirms = self.options.confirms()
+        if self.confirms:
+            if self.options.verbose():
+                self.log.show('INFO: Publisher confirms enabled\n')
+            self.source.confirm_delivery(channel, self.on_confirm)
+
+    # then(ok) вызывается после подтверждения брокером (сразу, если confirms выключены)
+    def publish(self, channel, routing_key, body, properties, then, exchange=''):
+        ok = channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+        if not self.confirms:
+            then(True)
+        elif self.source.async_confirms:
+            self.seq += 1
+            self.waiting[self.seq] = then
+        else:
+            then(ok is not False)
+
+    def on_confirm(self, frame):
+        method = frame.method
+        ok = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            tags = sorted(t for t in self.waiting if t <= method.delivery_tag)
+        else:
+            tags = [method.delivery_tag]
+        for t in tags:
+            then = self.waiting.pop(t, None)
+            if then is not None:
+                then(ok)
+
+
+# Отложенный повтор сообщений через очереди с TTL и dead-letter в исходную очередь
+class Retrier(object):
+
+    HEADER = 'x-retry-attempt'
+    ROUTING_KEY = 'x-routing-key'
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.options = App().registry().get('options')
+        self.source = None
+        self.route = None
+        self.queue = None
+        self.declared = set()
+
+    def init(self, source, route, queue):
+        self.source = source
+        self.route = route
+        self.queue = queue
+        self.declared = set()
+
+    # Число уже сделанных неудачных попыток
+    def attempts(self, props):
+        if props.headers and Retrier.HEADER in props.headers:
+            try:
+                return int(props.headers[Retrier.HEADER])
+            except (TypeError, ValueError):
+                pass
+        return 0
+
+    # Отправить сообщение на повтор, по публикации вызывается then(ok). False, если попытки исчерпаны
+    def retry(self, delivery, policy, then):
+        attempt = self.attempts(delivery.props) + 1
+        if policy.exhausted(attempt):
+            self.log.show("WARNING: Message has failed %d attempt(s). Rejecting\n" % attempt)
+            return False
+        ms = Retrier.bucket(policy.backoff(attempt))
+        routing_key = self.declare(ms)
+        if self.options.verbose():
+            self.log.show('INFO: Retry attempt %d in %d ms\n' % (attempt, ms))
+        self.route.publisher.publish(delivery.channel, routing_key, delivery.content(),
+                                     self.properties(delivery.props, attempt, delivery.method.routing_key), then)
+        return True
+
+    # Отложить сообщение на seconds без увеличения номера попытки
+    def defer(self, delivery, seconds, then):
+        attempt = self.attempts(delivery.props)
+        ms = Retrier.bucket(seconds)
+        routing_key = self.declare(ms)
+        if self.options.verbose():
+            self.log.show('INFO: Message deferred for %d ms\n' % ms)
+        self.route.publisher.publish(delivery.channel, routing_key, delivery.content(),
+                                     self.properties(delivery.props, attempt, delivery.method.routing_key), then)
+
+    # Объявить очередь задержки. Сообщения из неё по истечении TTL возвращаются в исходную очередь
+    def declare(self, ms):
+        if ms <= 0:
+            return self.queue
+        name = '%s.retry.%d' % (self.queue, ms)
+        if name not in self.declared:
+            self.source.queue_declare(self.route.channel, queue=name, durable=True, arguments={
+                'x-message-ttl': ms,
+                'x-dead-letter-exchange': '',
+                'x-dead-letter-routing-key': self.queue,
+                'x-expires': ms * 2 + 60000
+            })
+            self.declared.add(name)
+        return name
+
+    def properties(self, props, attempt, routing_key):
+        headers = dict(props.headers or {})
+        headers[Retrier.HEADER] = attempt
+        headers.setdefault(Retrier.ROUTING_KEY, routing_key)
+        return pika.BasicProperties(content_type=props.content_type,
+                                    content_encoding=props.content_encoding,
+                                    headers=headers,
+                                    delivery_mode=props.delivery_mode,
+                                    priority=props.priority,
+                                    correlation_id=props.correlation_id,
+                                    reply_to=props.reply_to,
+                                    message_id=props.message_id,
+                                    timestamp=props.timestamp,
+                                    type=props.type,
+                                    app_id=props.app_id)
+
+    # Округлить задержку до ступени с шагом ~19%, чтобы число очередей задержки было ограничено
+    @staticmethod
+    def bucket(seconds):
+        ms = seconds * 1000.0
+        if ms < 1:
+            return 0
+        return int(round(2 ** (round(math.log(ms, 2) * 4) / 4)))
 
 
 # Базовый класс источника комманд
@@ -660,6 +3561,7 @@ class CommandSource(object):
         self.log = App().registry().get('log')
         self.sys = App().registry().get('sys')
         self.runner = App().registry().get('command_runner')
+        self.reload_requested = False
 
     def init(self):
         self.options = App().registry().get('options')
@@ -668,6 +3570,20 @@ class CommandSource(object):
         self.log.show("ERROR: Abstract command source has been invoked\n")
         self.sys.die('action_abstract_run')
 
+    # Запросы из обработчиков сигналов только ставят флаги: лог и перезагрузка выполняются в цикле источника.
+    # False - источник не умеет дорабатывать полученное и завершается сразу
+    def request_drain(self, num):
+        return False
+
+    def request_reload(self):
+        self.reload_requested = True
+
+    # Выполнить запрошенную сигналом перезагрузку
+    def check_reload(self):
+        if self.reload_requested:
+            self.reload_requested = False
+            App().reload()
+
     @staticmethod
     def make(source):
         sources = App().registry().get('command_sources')
@@ -685,7 +3601,9 @@ class RawInputCommandSource(CommandSource):
     def run(self):
         try:
             while True:
+                self.check_reload()
                 i = raw_input('INPUT: stdin >')
+                self.check_reload()
                 self.runner.run(i)
         except (KeyboardInterrupt, EOFError):
             self.log.show("\nINFO: End of input\n")
@@ -695,14 +3613,102 @@ class RawInputCommandSource(CommandSource):
 # Класс получения комманд через RabbitMQ
 class RabbitMQCommandSource(CommandSource):
 
+    # Публикации подтверждаются синхронно в basic_publish
+    async_confirms = False
+    MIN_BACKOFF = 1
+
     def __init__(self):
         super(RabbitMQCommandSource, self).__init__()
         self.connection = None
-        self.chan = None
+        self.routes = App().registry().get('routes')
+        self.channels = {} # канал -> маршрут
+        self.batches = {}  # (очередь, действие) -> собираемый пакет
+        self.acks = {}     # канал -> Acks
+        self.exiting = False
+        self.drain_requested = None  # номер сигнала остановки
+        self.draining = False
+        self.drain_deadline = None
+        self.candidates = []
+        self.candidate = 0  # номер брокера в candidates для следующей попытки
+        self.delay = RabbitMQCommandSource.MIN_BACKOFF
+        self.metrics = App().registry().get('metrics')
+        self.results = App().registry().get('result_cache')
+        self.spool = App().registry().get('spool')
 
     def init(self):
         super(RabbitMQCommandSource, self).init()
 
+        self.candidates = self.connection_candidates()
+        try:
+            self.connect()
+        except pika.exceptions.AMQPError as e:
+            self.log.show("ERROR: Can't connect to RabbitMQ. Reason: %s\n" % e)
+            self.sys.die('amqp_io_error')
+        self.pools()
+        try:
+            for route in self.routes:
+                self.open(route)
+        except pika.exceptions.AMQPError as e:
+            self.log.show("ERROR: Can't start RabbitMQ message receiving. Reason: %s\n" % e)
+            self.sys.die('amqp_rec_error')
+
+    # Пулы потоков для обработки сообщений маршрутов. Переживают переподключения.
+    # Действия не выполняются в потоке соединения, чтобы он продолжал обслуживать heartbeat
+    def pools(self):
+        for route in self.routes:
+            route.pool = WorkerPool(self)
+            route.pool.init(route.concurrency, route.queue)
+
+    # Соединиться с первым доступным брокером, начиная с candidate
+    def connect(self):
+        error = None
+        for _ in range(len(self.candidates)):
+            parms = self.candidates[self.candidate]
+            try:
+                self.connection = pika.BlockingConnection(parms)
+                return
+            except pika.exceptions.AMQPConnectionError as e:
+                self.log.show("WARNING: Can't connect to RabbitMQ at %s:%s. Reason: %s\n" % (parms.host, parms.port, e))
+                error = e
+                self.candidate = (self.candidate + 1) % len(self.candidates)
+        raise error
+
+    # Открыть канал маршрута и начать приём сообщений из его очереди
+    def open(self, route):
+        route.channel = self.connection.channel()
+        self.channels[route.channel] = route
+        if route.prefetch is not None:
+            if self.options.verbose():
+                self.log.show("INFO: RabbitMQ prefetch count for '%s': %d\n" % (route.queue, route.prefetch))
+            route.channel.basic_qos(prefetch_count=route.prefetch)
+
+        queue_parms = self.queue_parameters(route)
+        if self.options.get(u'build_queue'):
+            result = self.queue_declare(route.channel, **queue_parms)
+            queue_name = result.method.queue
+        else:
+            queue_name = queue_parms['queue']
+        self.consume(route, queue_name)
+
+    # Параметры соединения с брокерами из hosts (или host и port) в порядке перебора
+    def connection_candidates(self):
+        connection_parms = self.connection_parameters()
+        hosts = self.options.get(u'hosts') if self.options.has('hosts') else [{}]
+        candidates = []
+        for host in hosts:
+            parms = dict(connection_parms)
+            if isinstance(host, dict):
+                parms.update((str(k), v) for k, v in host.items() if k in ('host', 'port'))
+            else:
+                name, _, port = host.partition(':')
+                parms['host'] = name
+                if port:
+                    parms['port'] = int(port)
+            candidates.append(pika.ConnectionParameters(**parms))
+        return candidates
+
+    # Параметры соединения с RabbitMQ из опций
+    def connection_parameters(self):
         connection_parms = {}
         # Установить аутентификацию RabbitMQ
         if self.options.has('host'):
@@ -719,48 +3725,62 @@ class RabbitMQCommandSource(CommandSource):
             connection_parms['locale'] = self.options.get(u'locale')
         if self.options.has('connection_attempts'):
             connection_parms['connection_attempts'] = self.options.get(u'connection_attempts')
-
-            # Установить соединение с RabbitMQ
+        if self.options.has('retry_delay'):
+            connection_parms['retry_delay'] = self.options.get(u'retry_delay')
+        if self.options.has('socket_timeout'):
+            connection_parms['socket_timeout'] = self.options.get(u'socket_timeout')
+        # Пульс обнаруживает потерю брокера; при долгих действиях в потоке соединения его стоит увеличить
+        if self.options.has('heartbeat'):
+            connection_parms['heartbeat'] = self.options.get(u'heartbeat')
+        if self.options.has('blocked_connection_timeout'):
+            connection_parms['blocked_connection_timeout'] = self.options.get(u'blocked_connection_timeout')
+
+        # Установить соединение с RabbitMQ
         if self.options.verbose():
             self.log.show('INFO: Open connection to RabbitMQ\n')
         if self.options.debug():
             self.log.show('DEBUG: RabbitMQ connection parameters:\n')
             self.log.dump(connection_parms)
-        try:
-            self.connection = pika.BlockingConnection(pika.ConnectionParameters(**connection_parms))
-            self.chan = self.connection.channel()
-        except pika.exceptions.AMQPError as e:
-            self.log.show("ERROR: Can't connect to RabbitMQ. Reason: %s\n" % e)
-            self.sys.die('amqp_io_error')
+        return connection_parms
 
-        queue_parms = {}
-        if self.options.has('queue'):
-            queue_parms['queue'] = self.options.get(u'queue')
+    # Параметры объявления очереди маршрута
+    def queue_parameters(self, route):
+        queue_parms = dict(route.declare)
+        if route.queue:
+            queue_parms['queue'] = route.queue
         else:
             self.log.show('ERROR: RabbitMQ queue name does not specified\n')
             self.sys.die('amqp_no_queue')
-        if self.options.has('durable'):
-            queue_parms['durable'] = self.options.get(u'durable')
-        if self.options.has('exclusive'):
-            queue_parms['exclusive'] = self.options.get(u'exclusive')
 
         if self.options.verbose():
             self.log.show("INFO: Binding to RabbitMQ queue'\n")
         if self.options.debug():
             self.log.show('DEBUG: RabbitMQ queue_declare parameters:\n')
             self.log.dump(queue_parms)
-        try:
-            if self.options.get(u'build_queue'):
-                result = self.chan.queue_declare(**queue_parms)
-                queue_name = result.method.queue
-            else:
-                queue_name = queue_parms['queue']
-            if self.options.verbose():
-                self.log.show("INFO: Start listening RabbitMQ queue: '%s'\n" % queue_name)
-            self.chan.basic_consume(self.on_receive, queue=queue_name, no_ack=False)
-        except pika.exceptions.AMQPError as e:
-            self.log.show("ERROR: Can't start RabbitMQ message receiving. Reason: %s\n" % e)
-            self.sys.die('amqp_rec_error')
+        return queue_parms
+
+    def queue_declare(self, channel, **queue_parms):
+        return channel.queue_declare(**queue_parms)
+
+    def confirm_delivery(self, channel, callback):
+        channel.confirm_delivery()
+
+    def acks_for(self, channel):
+        if channel not in self.acks:
+            self.acks[channel] = Acks(self, channel)
+        return self.acks[channel]
+
+    # Начать приём сообщений из очереди маршрута
+    def consume(self, route, queue_name):
+        route.publisher = Publisher(self)
+        route.publisher.init(route.channel)
+        if self.options.delayed_retry():
+            route.retrier = Retrier()
+            route.retrier.init(self, route, queue_name)
+            App().registry().set('retrier', route.retrier)
+        if self.options.verbose():
+            self.log.show("INFO: Start listening RabbitMQ queue: '%s'\n" % queue_name)
+        route.consumer_tag = route.channel.basic_consume(self.on_receive, queue=queue_name, no_ack=False)
 
     # Обработкчик сообщений
     def on_receive(self, channel, method, props, body):
@@ -770,41 +3790,390 @@ class RabbitMQCommandSource(CommandSource):
                 self.log.show('INFO: correlation_id: %d\n' % props.correlation_id)
             else:
                 self.log.show('INFO: correlation_id: None\n')
-        if self.options.debug():
-            self.log.show('DEBUG: Message body:\n')
-            self.log.dump(body)
         if isinstance(body, basestring):
-            if self.runner.run(body) == 0:
+            delivery = Delivery(channel, method, props, body)
+            delivery.route = self.channels[channel]
+            delivery.action = delivery.route.select(method, props, body)
+            self.acks_for(channel).received(method.delivery_tag)
+            if not self.known(delivery):
+                return
+            self.metrics.count('received', delivery.action)
+            if not self.claim(delivery):
+                return
+            if self.options.debug():
+                self.log.show('DEBUG: Message body:\n')
+                self.log.dump(delivery.input())
+            if not self.collect(delivery):
+                self.dispatch(delivery)
+        else:
+            self.log.show('ERROR: Message is not a string!\n')
+            self.sys.die('message_bad')
+
+    # Взять большое тело или тело по ссылке из хранилища. False - файла нет, сообщение отклонено
+    def claim(self, delivery):
+        try:
+            delivery.claim = self.spool.claim(delivery.props, delivery.body)
+        except EnvironmentError as e:
+            self.log.show('ERROR: Message body is not found in spool. Rejecting\nReason: %s\n' % e)
+            self.refuse(delivery)
+            return False
+        if delivery.claim is not None and not delivery.claim.reference:
+            delivery.body = None
+        return True
+
+    # Имя действия, выбранное самим сообщением, должно быть в конфиге. Иначе сообщение отклоняется без повтора:
+    # повторная доставка ничего не изменит, а die_on_unknown_command останавливал бы рабочих на каждой доставке
+    def known(self, delivery):
+        name = delivery.action
+        if name is None or name in self.runner.actions.descriptions or name in delivery.route.configured:
+            return True
+        self.log.show("WARNING: Message requests unknown action '%s'. Rejecting\n" % name)
+        # Имя из сообщения не попадает в метки метрик
+        delivery.action = None
+        self.refuse(delivery)
+        return False
+
+    # Отклонить сообщение без повтора до выполнения действия
+    def refuse(self, delivery):
+        with self.metrics.timer('ack', delivery.action):
+            self.acks_for(delivery.channel).nack(delivery.method.delivery_tag, requeue=False)
+        self.metrics.count('messages', delivery.action, result='reject')
+
+    # Выполнить сразу или передать в пул маршрута
+    def dispatch(self, delivery):
+        if delivery.route.pool is None:
+            self.execute(delivery)
+            self.complete(delivery)
+        else:
+            delivery.route.pool.submit(delivery)
+
+    # Добавить сообщение в пакет, если действие обрабатывает пакеты.
+    # Ещё не созданное действие выполняется без пакета: его создаст поток пула
+    def collect(self, delivery):
+        action = self.runner.actions.built(delivery.action)
+        if action is None or action.batch_size <= 1:
+            return False
+        # Пакет собирается в пределах одной очереди: ACK с multiple возможен только на одном канале
+        key = (delivery.route.queue, delivery.action)
+        batch = self.batches.get(key)
+        if batch is None:
+            batch = Batch(delivery.action, delivery.route)
+            batch.timer = self.connection.add_timeout(action.batch_linger,
+                                                      functools.partial(self.flush, key))
+            self.batches[key] = batch
+        batch.deliveries.append(delivery)
+        if len(batch) >= action.batch_size:
+            self.connection.remove_timeout(batch.timer)
+            self.flush(key)
+        return True
+
+    # Отправить собранный пакет на выполнение
+    def flush(self, key):
+        batch = self.batches.pop(key, None)
+        if batch is not None:
+            if self.options.debug():
+                self.log.show('DEBUG: Flush %s\n' % batch)
+            self.dispatch(batch)
+
+    # Поля сообщения в структурированном логе текущего потока
+    def bind(self, delivery):
+        if isinstance(delivery, Batch):
+            self.log.bind(action=delivery.action,
+                          delivery_tags=[d.method.delivery_tag for d in delivery.deliveries])
+        else:
+            self.log.bind(action=delivery.action,
+                          delivery_tag=delivery.method.delivery_tag,
+                          correlation_id=delivery.props.correlation_id,
+                          message_id=delivery.props.message_id)
+        if isinstance(delivery, Batch):
+            self.results.bind(None)
+        else:
+            self.results.bind(delivery.props.message_id, self.options.replies() and bool(delivery.props.reply_to))
+
+    # Выполнить действие для сообщения или пакета (может вызываться из потока пула)
+    def execute(self, delivery):
+        self.bind(delivery)
+        try:
+            self.run_action(delivery)
+        finally:
+            self.log.unbind()
+
+    def run_action(self, delivery):
+        if isinstance(delivery, Batch):
+            with self.metrics.timer('batch', delivery.action):
+                results = self.runner.run_batch(delivery.action, [d.input() for d in delivery.deliveries])
+            for d, result in zip(delivery.deliveries, results):
+                d.result = result
+        else:
+            with self.metrics.timer('action', delivery.action):
+                delivery.result, delivery.output = self.runner.call(delivery.input(), delivery.action)
+
+    # Вызывается в потоке соединения после выполнения действия
+    def complete(self, delivery):
+        try:
+            if self.stale(delivery):
+                if self.options.verbose():
+                    self.log.show('INFO: %s was received before reconnection and will be redelivered\n' % delivery)
+                return
+            self.bind(delivery)
+            try:
+                self.settle_delivery(delivery)
+            finally:
+                self.log.unbind()
+        finally:
+            self.release(delivery)
+
+    # Закрыть отображения тел из хранилища. Повтор уже опубликован, файлы по ссылке остаются до подтверждения
+    def release(self, delivery):
+        for d in delivery.deliveries if isinstance(delivery, Batch) else [delivery]:
+            if d.claim is not None:
+                d.claim.close()
+
+    def settle_delivery(self, delivery):
+        if isinstance(delivery, Batch):
+            now = time.time()
+            for d in delivery.deliveries:
+                self.metrics.observe('total', d.action, now - d.received)
+            self.settle_batch(delivery)
+        else:
+            self.metrics.observe('total', delivery.action, time.time() - delivery.received)
+            self.settle(delivery)
+
+    # Сообщение получено по каналу потерянного соединения: подтвердить его уже нельзя
+    def stale(self, delivery):
+        if isinstance(delivery, Batch):
+            return delivery.deliveries[0].channel not in self.channels
+        return delivery.channel not in self.channels
+
+    # Успешный пакет подтверждается одним ACK с multiple, если ниже него нет чужих неподтверждённых
+    def settle_batch(self, batch):
+        if (all(d.result == 0 for d in batch.deliveries)
+                and not (self.options.replies() and any(d.props.reply_to for d in batch.deliveries))):
+            if self.options.verbose():
+                self.log.show('INFO: Batch of %d executed successfully. Sending ACK\n' % len(batch))
+            with self.metrics.timer('ack', batch.action):
+                self.acks_for(batch.deliveries[0].channel).ack_all([d.method.delivery_tag for d in batch.deliveries])
+            self.metrics.count('messages', batch.action, len(batch), result='ack')
+            for d in batch.deliveries:
+                self.spool.discard(d.claim)
+            if self.options.one_shot():
                 if self.options.verbose():
-                    self.log.show('INFO: Action executed successfully. Sending ACK\n')
-                channel.basic_ack(delivery_tag=method.delivery_tag)
+                    self.log.show('INFO: Action processed. Exit\n')
+                self.exit()
+        else:
+            for d in batch.deliveries:
+                self.settle(d)
+
+    # Отправить ACK/NACK по результату действия. Только в потоке соединения
+    def settle(self, delivery):
+        if delivery.result == 0:
+            if self.options.verbose():
+                self.log.show('INFO: Action executed successfully. Sending ACK\n')
+            self.reply(delivery, functools.partial(self.published, delivery, 'ack'))
 
-                if self.options.one_shot():
-                    if self.options.verbose():
-                        self.log.show('INFO: Action processed. Exit\n')
-                    self.sys.die('ok')
-            else:
-                if self.options.get(u'auto_ack'):
-                    if self.options.verbose():
-                        self.log.show('INFO: Action does not executed successfully. Sending ACK\n')
-                    channel.basic_ack(delivery_tag=method.delivery_tag)
-                else:
-                    if self.options.verbose():
-                        self.log.show('INFO: Action does not executed successfully. Sending NACK\n')
-                    channel.basic_nack(delivery_tag=method.delivery_tag)
             if self.options.one_shot():
                 if self.options.verbose():
-                    self.log.show('INFO: One shot action. Exit\n')
-                self.sys.die('ok')
+                    self.log.show('INFO: Action processed. Exit\n')
+                self.exit()
+                return
         else:
-            self.log.show('ERROR: Message is not a string!\n')
-            self.sys.die('message_bad')
+            action = self.runner.actions.built(delivery.action)
+            if delivery.result == Action.DEFERRED and action is None:
+                self.postpone(delivery, max(self.runner.actions.backoff(delivery.action) or 0, 1))
+            elif delivery.result == Action.DEFERRED and delivery.route.retrier is not None and action is not None:
+                delivery.route.retrier.defer(delivery, action.deferral(),
+                                             functools.partial(self.published, delivery, 'deferred'))
+            elif self.options.get(u'auto_ack'):
+                if self.options.verbose():
+                    self.log.show('INFO: Action does not executed successfully. Sending ACK\n')
+                self.reply(delivery, functools.partial(self.published, delivery, 'ack'))
+            elif delivery.route.retrier is not None and action is not None and action.retry.enabled():
+                if not delivery.route.retrier.retry(delivery, action.retry, functools.partial(self.published, delivery, 'retry')):
+                    self.reply(delivery, functools.partial(self.published, delivery, 'reject'))
+            else:
+                if self.options.verbose():
+                    self.log.show('INFO: Action does not executed successfully. Sending NACK\n')
+                with self.metrics.timer('ack', delivery.action):
+                    self.acks_for(delivery.channel).nack(delivery.method.delivery_tag)
+                self.metrics.count('messages', delivery.action, result='nack')
+        if self.options.one_shot():
+            if self.options.verbose():
+                self.log.show('INFO: One shot action. Exit\n')
+            self.exit()
+
+    # Действие не удалось создать: вернуть сообщение в очередь не раньше, чем через seconds.
+    # Без отложенных повторов NACK откладывается, чтобы сообщение не возвращалось в цикле
+    def postpone(self, delivery, seconds):
+        if delivery.route.retrier is not None:
+            delivery.route.retrier.defer(delivery, seconds, functools.partial(self.published, delivery, 'deferred'))
+        else:
+            self.connection.add_timeout(seconds, functools.partial(self.requeue, delivery))
+
+    def requeue(self, delivery):
+        if self.stale(delivery):
+            return
+        with self.metrics.timer('ack', delivery.action):
+            self.acks_for(delivery.channel).nack(delivery.method.delivery_tag)
+        self.metrics.count('messages', delivery.action, result='nack')
+
+    # Опубликовать результат в reply_to, если он указан
+    def reply(self, delivery, then):
+        props = delivery.props
+        if not (self.options.replies() and props.reply_to):
+            then(True)
+            return
+        if self.options.verbose():
+            self.log.show("INFO: Sending reply to '%s'\n" % props.reply_to)
+        properties = pika.BasicProperties(correlation_id=props.correlation_id,
+                                          headers={'x-result-code': delivery.result})
+        delivery.route.publisher.publish(delivery.channel, props.reply_to,
+                               delivery.output if delivery.output is not None else '', properties, then)
+
+    # Ответ или повтор опубликованы: ACK, или отказ без повтора для result 'reject'.
+    # Если брокер не принял публикацию, сообщение возвращается в очередь
+    def published(self, delivery, result, ok):
+        acks = self.acks_for(delivery.channel)
+        with self.metrics.timer('ack', delivery.action):
+            if not ok:
+                self.log.show('WARNING: Publication is not confirmed by RabbitMQ. Sending NACK\n')
+                acks.nack(delivery.method.delivery_tag)
+                result = 'nack'
+            elif result == 'reject':
+                acks.nack(delivery.method.delivery_tag, requeue=False)
+            else:
+                acks.ack(delivery.method.delivery_tag)
+        if result in ('ack', 'reject'):
+            self.spool.discard(delivery.claim)
+        self.metrics.count('messages', delivery.action, result=result)
+        if self.exiting and not self.routes.waiting():
+            self.sys.die('ok')
+
+    # Выход в режиме one shot после подтверждения всех публикаций
+    def exit(self):
+        if self.routes.waiting():
+            self.exiting = True
+        else:
+            self.sys.die('ok')
+
+    def flush_acks(self):
+        for acks in self.acks.values():
+            acks.flush()
 
+    # Повторный сигнал во время остановки завершает процесс сразу
+    def request_drain(self, num):
+        if self.drain_requested:
+            return False
+        self.drain_requested = num
+        return True
+
+    # Запросы от сигналов выполняются в потоке соединения, а не в обработчике сигнала
+    def check(self):
+        self.check_reload()
+        if self.drain_requested and not self.draining:
+            if self.options.verbose():
+                self.log.show('INFO: Got signal %d. Stopping\n' % self.drain_requested)
+            self.drain()
+        if self.draining:
+            busy = self.busy()
+            if busy and time.time() < self.drain_deadline:
+                return
+            if busy:
+                self.log.show('WARNING: Drain timeout. %d message(s) will be redelivered\n' % busy)
+            elif self.options.verbose():
+                self.log.show('INFO: All messages processed. Exit\n')
+            self.sys.die('ok')
+
+    # Остановка без потери работы: перестать получать сообщения, дождаться обработки полученных
+    def drain(self):
+        self.draining = True
+        self.drain_deadline = time.time() + self.options.drain_timeout()
+        if self.options.verbose():
+            self.log.show('INFO: Draining %d in-flight message(s)\n' % self.busy())
+        for route in self.routes:
+            if route.consumer_tag is not None and route.channel.is_open:
+                route.channel.basic_cancel(consumer_tag=route.consumer_tag)
+                route.consumer_tag = None
+        for key, batch in self.batches.items():
+            self.connection.remove_timeout(batch.timer)
+            self.flush(key)
+
+    # Число сообщений, по которым ещё не отправлено подтверждение
+    def busy(self):
+        return (sum(len(a.unsettled) for a in self.acks.values()) +
+                sum(1 for r in self.routes if r.publisher is not None and r.publisher.waiting))
+
+    # Передать вызов в поток соединения. Закрытое соединение вызовы не принимает:
+    # результат для него уже не нужен, сообщение будет доставлено заново
+    def threadsafe(self, callback):
+        try:
+            self.connection.add_callback_threadsafe(callback)
+        except pika.exceptions.AMQPError:
+            pass
+
+    # Забыть состояние потерянного соединения. Неподтверждённые сообщения брокер вернёт в очередь,
+    # выполняющиеся в пуле действия завершатся, но их результат не будет подтверждён
+    def reset(self, reason):
+        lost = self.busy() + sum(len(b) for b in self.batches.values())
+        self.log.show('WARNING: RabbitMQ connection lost. Reason: %s\n' % reason)
+        if lost:
+            self.log.show('WARNING: %d in-flight message(s) will be redelivered\n' % lost)
+        self.metrics.count('reconnects', None)
+        self.channels = {}
+        self.acks = {}
+        self.batches = {}
+        for route in self.routes:
+            route.channel = None
+            route.consumer_tag = None
+            route.publisher = None
+            route.retrier = None
+        self.exiting = False
+
+    # Пауза перед следующей попыткой переподключения, удваивается до reconnect_max_delay
+    def backoff(self):
+        delay = self.delay
+        self.delay = min(delay * 2, self.options.reconnect_max_delay())
+        return delay
+
+    # Переподключиться с перебором брокеров и заново начать приём из всех очередей
+    def recover(self, reason):
+        self.reset(reason)
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        while True:
+            delay = self.backoff()
+            if self.options.verbose():
+                self.log.show('INFO: Reconnecting to RabbitMQ in %g s\n' % delay)
+            time.sleep(delay)
+            if self.drain_requested:
+                # Полученные сообщения вернутся в очередь, дожидаться нечего
+                self.sys.die('ok')
+            try:
+                self.connect()
+                for route in self.routes:
+                    self.open(route)
+            except pika.exceptions.AMQPError as e:
+                self.log.show("WARNING: Can't restore RabbitMQ connection. Reason: %s\n" % e)
+                self.channels = {}
+                continue
+            self.delay = RabbitMQCommandSource.MIN_BACKOFF
+            self.log.show('INFO: RabbitMQ connection restored\n')
+            return
 
     # Запустить приёмник
     def run(self):
         try:
-            self.chan.start_consuming()
+            while True:
+                try:
+                    while self.connection.is_open:
+                        self.connection.process_data_events(time_limit=1)
+                        self.check()
+                    break
+                except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                    if not self.options.reconnect() or self.draining:
+                        raise
+                    self.recover(e)
         except pika.exceptions.AMQPError as e:
             self.log.show("ERROR: RabbitMQ consumer crash\nReason: %s\n" % e)
             self.sys.die('amqp_rec_error')
@@ -813,9 +4182,326 @@ class RabbitMQCommandSource(CommandSource):
                 self.log.show("INFO: Program interrupted\n")
             self.sys.die('ok')
         finally:
-            self.chan.stop_consuming()
+            for route in self.routes:
+                if route.pool is not None:
+                    route.pool.stop()
+                if route.channel is not None and route.channel.is_open:
+                    route.channel.stop_consuming()
+            self.flush_acks()
             self.connection.close()
 
+# Класс получения комманд через RabbitMQ в цикле событий (SelectConnection)
+class SelectRabbitMQCommandSource(RabbitMQCommandSource):
+
+    # Подтверждения публикаций приходят асинхронно через on_confirm
+    async_confirms = True
+    # Период проверки запросов от сигналов
+    CHECK_INTERVAL = 0.5
+
+    def __init__(self):
+        super(SelectRabbitMQCommandSource, self).__init__()
+        self.closing = False
+        self.connected = False  # соединение хотя бы раз было открыто
+
+    def init(self):
+        CommandSource.init(self)
+        self.candidates = self.connection_candidates()
+        self.connect()
+        self.pools()
+
+    # Действия без поддержки цикла событий выполняются в пуле потоков маршрута
+    def pools(self):
+        for route in self.routes:
+            route.pool = WorkerPool(self)
+            route.pool.init(route.threads, route.queue)
+
+    # Новое соединение работает в том же цикле событий, что и прежнее
+    def connect(self, ioloop=None):
+        self.connection = pika.SelectConnection(self.candidates[self.candidate],
+                                                on_open_callback=self.on_open,
+                                                on_open_error_callback=self.on_open_error,
+                                                on_close_callback=self.on_closed,
+                                                stop_ioloop_on_close=False,
+                                                custom_ioloop=ioloop)
+
+    # Канал на каждый маршрут в общем соединении
+    def on_open(self, connection):
+        if self.connected:
+            self.log.show('INFO: RabbitMQ connection restored\n')
+        self.connected = True
+        self.delay = RabbitMQCommandSource.MIN_BACKOFF
+        for route in self.routes:
+            connection.channel(on_open_callback=functools.partial(self.on_channel, route))
+
+    # Таймер цикла событий переживает переподключения
+    def on_check(self):
+        self.check()
+        self.connection.ioloop.add_timeout(SelectRabbitMQCommandSource.CHECK_INTERVAL, self.on_check)
+
+    # При первом запуске недоступность всех брокеров фатальна, после потери соединения - нет
+    def on_open_error(self, connection, error):
+        parms = self.candidates[self.candidate]
+        self.log.show("WARNING: Can't connect to RabbitMQ at %s:%s. Reason: %s\n" % (parms.host, parms.port, error))
+        self.candidate = (self.candidate + 1) % len(self.candidates)
+        if not self.connected:
+            if self.candidate == 0:
+                self.log.show("ERROR: Can't connect to RabbitMQ. Reason: %s\n" % error)
+                self.sys.die('amqp_io_error')
+            self.connect(connection.ioloop)
+        else:
+            self.reconnect(connection)
+
+    def on_closed(self, connection, reply_code, reply_text):
+        if self.closing:
+            connection.ioloop.stop()
+            return
+        reason = '%s %s' % (reply_code, reply_text)
+        if not self.options.reconnect() or self.draining:
+            self.log.show("ERROR: RabbitMQ connection closed\nReason: %s\n" % reason)
+            self.sys.die('amqp_rec_error')
+        self.reset(reason)
+        self.reconnect(connection)
+
+    # Следующая попытка соединения после паузы
+    def reconnect(self, connection):
+        delay = self.backoff()
+        if self.options.verbose():
+            self.log.show('INFO: Reconnecting to RabbitMQ in %g s\n' % delay)
+        connection.ioloop.add_timeout(delay, functools.partial(self.connect, connection.ioloop))
+
+    def on_channel(self, route, chan):
+        route.channel = chan
+        self.channels[chan] = route
+        if route.prefetch is not None:
+            if self.options.verbose():
+                self.log.show("INFO: RabbitMQ prefetch count for '%s': %d\n" % (route.queue, route.prefetch))
+            chan.basic_qos(callback=functools.partial(self.on_qos, route), prefetch_count=route.prefetch)
+        else:
+            self.on_qos(route, None)
+
+    def on_qos(self, route, frame):
+        queue_parms = self.queue_parameters(route)
+        if self.options.get(u'build_queue'):
+            self.queue_declare(route.channel, callback=functools.partial(self.on_queue, route), **queue_parms)
+        else:
+            self.consume(route, queue_parms['queue'])
+
+    def on_queue(self, route, frame):
+        self.consume(route, frame.method.queue)
+
+    def queue_declare(self, channel, callback=None, **queue_parms):
+        channel.queue_declare(callback, **queue_parms)
+
+    def confirm_delivery(self, channel, callback):
+        channel.confirm_delivery(callback)
+
+    def dispatch(self, delivery):
+        delivery.started = time.time()
+        if (isinstance(delivery, Batch) or
+                not self.runner.start(delivery.input(), self.connection.ioloop,
+                                      functools.partial(self.finish, delivery), delivery.action)):
+            delivery.route.pool.submit(delivery)
+
+    def finish(self, delivery, result, output=None):
+        self.metrics.observe('action', delivery.action, time.time() - delivery.started)
+        delivery.result = result
+        delivery.output = output
+        self.complete(delivery)
+
+    def threadsafe(self, callback):
+        self.connection.ioloop.add_callback_threadsafe(callback)
+
+    def run(self):
+        try:
+            self.on_check()
+            self.connection.ioloop.start()
+        except pika.exceptions.AMQPError as e:
+            self.log.show("ERROR: RabbitMQ consumer crash\nReason: %s\n" % e)
+            self.sys.die('amqp_rec_error')
+        except (KeyboardInterrupt, EOFError):
+            if self.options.verbose():
+                self.log.show("INFO: Program interrupted\n")
+            self.sys.die('ok')
+        finally:
+            for route in self.routes:
+                route.pool.stop()
+            self.closing = True
+            if self.connection.is_open:
+                self.flush_acks()
+                self.connection.close()
+                self.connection.ioloop.start()
+
+
+# Запускает несколько рабочих процессов с общей конфигурацией и перезапускает упавшие
+class Supervisor(object):
+
+    MIN_BACKOFF = 1
+    MAX_BACKOFF = 60
+
+    def __init__(self):
+        self.log = App().registry().get('log')
+        self.sys = App().registry().get('sys')
+        self.options = App().registry().get('options')
+        self.children = {}  # pid -> номер рабочего
+        self.started = {}   # номер рабочего -> время запуска
+        self.backoff = {}   # номер рабочего -> задержка перед перезапуском
+        self.pending = {}   # номер рабочего -> время перезапуска
+        self.stopping = False
+        self.stop_signal = None        # сигнал остановки, ещё не переданный рабочим
+        self.reload_requested = False
+
+    def init(self):
+        for n in range(self.options.workers()):
+            self.backoff[n] = Supervisor.MIN_BACKOFF
+            self.pending[n] = 0
+
+    def run(self):
+        for s in (signal.SIGTERM, signal.SIGUSR1, signal.SIGINT):
+            signal.signal(s, self.on_signal)
+        signal.signal(signal.SIGHUP, self.on_reload)
+        if self.options.verbose():
+            self.log.show('INFO: Supervisor started for %d worker(s)\n' % self.options.workers())
+        while not self.stopping or self.children:
+            self.check()
+            if not self.stopping:
+                now = time.time()
+                for n, at in self.pending.items():
+                    if at <= now:
+                        self.pending.pop(n, None)
+                        self.spawn(n)
+            self.reap()
+            if not self.children and not self.pending:
+                break
+            time.sleep(0.2)
+        if self.options.verbose():
+            self.log.show('INFO: All workers finished. Exit\n')
+        self.sys.die('ok')
+
+    def spawn(self, n):
+        self.log.sync()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            self.log.show("ERROR: Can't fork worker %d. Reason: %s\n" % (n, e))
+            self.schedule(n)
+            return
+        if pid == 0:
+            self.child(n)
+        self.children[pid] = n
+        self.started[n] = time.time()
+        if self.options.verbose():
+            self.log.show('INFO: Worker %d started with PID %d\n' % (n, pid))
+
+    # Код рабочего процесса. Никогда не возвращается в цикл супервизора
+    def child(self, n):
+        code = 0
+        try:
+            self.log.after_fork()
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            for s in (signal.SIGTERM, signal.SIGUSR1):
+                signal.signal(s, App.on_exit)
+            signal.signal(signal.SIGHUP, App.on_reload)
+            self.pin(n)
+            App().registry().set('worker_id', n)
+            App().serve()
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            else:
+                code = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            self.log.show("ERROR: Worker %d crashed. Reason: %s\n" % (n, e))
+            code = 1
+        finally:
+            self.log.close()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code & 0xff)
+
+    def reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return
+            n = self.children.pop(pid, None)
+            if n is None:
+                continue
+            code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            if code == 0 or self.stopping:
+                if self.options.verbose():
+                    self.log.show('INFO: Worker %d (PID %d) finished with code %d\n' % (n, pid, code))
+            else:
+                self.log.show('WARNING: Worker %d (PID %d) crashed with code %d\n' % (n, pid, code))
+                self.schedule(n)
+
+    # Перезапуск с экспоненциальной задержкой, сбрасываемой после долгой работы
+    def schedule(self, n):
+        if time.time() - self.started.get(n, time.time()) > Supervisor.MAX_BACKOFF:
+            self.backoff[n] = Supervisor.MIN_BACKOFF
+        delay = self.backoff[n]
+        self.backoff[n] = min(delay * 2, Supervisor.MAX_BACKOFF)
+        self.pending[n] = time.time() + delay
+        if self.options.verbose():
+            self.log.show('INFO: Worker %d will be restarted in %d second(s)\n' % (n, delay))
+
+    # Обработчики сигналов только ставят флаги: лог и рассылка сигналов рабочим выполняются в цикле run
+    def on_signal(self, num, stack):
+        self.stop_signal = num
+
+    def on_reload(self, num, stack):
+        self.reload_requested = True
+
+    # Выполнить запросы от сигналов
+    def check(self):
+        num = self.stop_signal
+        if num is not None:
+            self.stop_signal = None
+            if self.options.verbose():
+                self.log.show('INFO: Supervisor got signal %d. Stopping workers\n' % num)
+            self.stopping = True
+            self.pending = {}
+            self.forward(signal.SIGUSR1 if num == signal.SIGINT else num)
+        if self.reload_requested:
+            self.reload_requested = False
+            if self.options.verbose():
+                self.log.show('INFO: Supervisor got SIGHUP. Reloading workers\n')
+            # Перезагрузка конфигурации выполняется каждым рабочим процессом
+            self.forward(signal.SIGHUP)
+
+    def forward(self, num):
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, num)
+            except OSError:
+                pass
+
+    # Привязать рабочий процесс к процессору
+    def pin(self, n):
+        if not self.options.has('cpu_affinity') or self.options.get('cpu_affinity') is False:
+            return
+        cpus = self.options.get('cpu_affinity')
+        if not isinstance(cpus, list) or not cpus:
+            cpus = range(os.sysconf('SC_NPROCESSORS_ONLN'))
+        cpu = cpus[n % len(cpus)]
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            mask = (ctypes.c_ulong * 16)()
+            mask[cpu // 64] = 1 << (cpu % 64)
+            if libc.sched_setaffinity(0, ctypes.sizeof(mask), ctypes.byref(mask)) != 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            if self.options.verbose():
+                self.log.show('INFO: Worker %d pinned to CPU %d\n' % (n, cpu))
+        except (OSError, AttributeError) as e:
+            self.log.show("WARNING: Can't pin worker %d to CPU %d. Reason: %s\n" % (n, cpu, e))
+
+
 # Класс приложения
 class App (object):
     _reg = Registry()
@@ -861,7 +4547,9 @@ class App (object):
             'soap_badauth': 21,
             'soap_failed': 22,
             'rpc_no_method': 23,
-            'rpc_io_error': 24
+            'rpc_io_error': 24,
+            'json_rpc_failed': 25,
+            'source_unknown': 26
         })
         # Системные функции
         self.registry().set('sys', System())
@@ -869,6 +4557,8 @@ class App (object):
         self.registry().set('help', Help())
         # Вывод лога
         self.registry().set('log', Log())
+        # Метрики
+        self.registry().set('metrics', Metrics())
         # Хранилище опций + опции по умолчанию
         options = Options()
         options.set(u'config', 'rabbitworker.json')
@@ -883,10 +4573,16 @@ class App (object):
         self.registry().set('option_dispatcher', OptionDispatcher(sys.argv))
         self.registry().set('json-rpc', JsonRpc())
         self.registry().set('soap', Soap())
+        self.registry().set('wsdl_cache', WsdlCache())
+        self.registry().set('upstreams', Upstreams())
+        self.registry().set('result_cache', ResultCache())
+        self.registry().set('spool', Spool())
         self.registry().set('actions', Actions())
+        self.registry().set('routes', Routes())
         # Типы событий
         self.registry().set('actions_store', {
             'exec': ExecAction(),
+            'exec-persistent': PersistentExecAction(),
             'rts': RtsAction()
         })
         # Обработать опции коммандной строки
@@ -897,34 +4593,86 @@ class App (object):
         options = self.registry().get('options')
         options.load()
         options.validate()
+        self.registry().get('log').setup()
+        self.registry().get('metrics').init()
+        self.registry().get('wsdl_cache').init()
+        self.registry().get('result_cache').init()
+        self.registry().get('spool').init()
         # Настроить события
         self.registry().get('actions').init()
+        # Настроить маршруты очередь -> действие
+        self.registry().get('routes').init()
+        self.registry().get('actions').prepare(self.registry().get('routes').actions())
         # Установить исполнителя комманд
         self.registry().set('command_runner', CommandRunner())
         # Настроить источники комманд
         self.registry().set('command_sources', {
             'console': RawInputCommandSource(),
-            'rabbitmq': RabbitMQCommandSource()
+            'rabbitmq': RabbitMQCommandSource(),
+            'rabbitmq-select': SelectRabbitMQCommandSource()
         })
         # Выбрать источник комманд
-        self.registry().set('command_source', CommandSource.make(options.get(u'command_source')))
-        # Сигнал для завершения
-        signal.signal(signal.SIGUSR1, App.on_exit)
+        source = options.get(u'command_source')
+        if source == u'rabbitmq' and options.engine() == u'select':
+            source = u'rabbitmq-select'
+        self.registry().set('command_source', CommandSource.make(source))
+        # Сигналы для завершения и перезагрузки конфигурации
+        for s in (signal.SIGTERM, signal.SIGUSR1):
+            signal.signal(s, App.on_exit)
+        signal.signal(signal.SIGHUP, App.on_reload)
+        # Несколько рабочих процессов с уже загруженной конфигурацией
+        if options.workers() > 1:
+            self.registry().set('supervisor', Supervisor())
+            self.registry().get('supervisor').init()
 
     def run(self):
+        if self.registry().has('supervisor'):
+            self.registry().get('supervisor').run()
+        else:
+            self.serve()
+
+    # Запустить источник комманд в текущем процессе
+    def serve(self):
         try:
+            self.registry().get('metrics').start()
+            self.registry().get('actions').warmup()
             cs = self.registry().get('command_source')
             cs.init()
             cs.run()
         except (KeyboardInterrupt, EOFError):
             self.registry().get('sys').die('ok')
 
+    # Перечитать конфигурацию и пересоздать изменившиеся действия. Соединения и пулы не затрагиваются
+    def reload(self):
+        r = self.registry()
+        log = r.get('log')
+        options = r.get('options')
+        if options.verbose():
+            log.show('INFO: Reloading config\n')
+        if not options.reload():
+            log.show('ERROR: Config is not valid. Previous config is kept\n')
+            return
+        try:
+            r.get('actions').reload()
+        except SystemExit:
+            options.rollback()
+            log.show('ERROR: Actions are not valid. Previous config is kept\n')
+            return
+        r.get('command_runner').misses.clear()
+        if options.verbose():
+            log.show('INFO: Config reloaded\n')
+
+    # Остановка: источник дорабатывает полученные сообщения, иначе выход сразу.
+    # В обработчиках сигналов нельзя писать в лог: очередь лога могла быть захвачена прерванным кодом
     @staticmethod
     def on_exit(num, stack):
         r = App().registry()
-        if r.get('options').verbose():
-            r.get('log').show('INFO: Got SIGUSR1. Exit\n')
-        r.get('sys').die('ok')
+        if not r.get('command_source').request_drain(num):
+            r.get('sys').die('ok')
+
+    @staticmethod
+    def on_reload(num, stack):
+        App().registry().get('command_source').request_reload()
 
 
 # Запуск приложения
@@ -0,0 +1,566 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Нагрузочный тест rabbitworker: сообщения подаются в RabbitMQCommandSource.on_receive
+# через канал в памяти (или через настоящий брокер), замеряются msgs/sec, задержки и память.
+# Каждый сценарий выполняется в отдельном процессе, результаты пишутся по строке JSON на сценарий
+
+
+import sys
+import os
+import getopt
+import json
+import time
+import errno
+import shutil
+import tempfile
+import threading
+import resource
+import SocketServer
+import BaseHTTPServer
+import pika
+import rabbitworker
+from rabbitworker import App, CommandSource, RabbitMQCommandSource
+
+
+SCENARIOS = ('exec', 'persistent', 'rts', 'console')
+
+USAGE = '''rabbitworker benchmark
+
+Usage: rabbitworker_bench.py [options]
+
+    -h,     --help          Show this help
+    -s,     --scenarios     Comma separated scenarios: %s (default: all)
+    -n,     --messages      Messages per scenario (default: 2000)
+    -b,     --size          Message body size in bytes (default: 100)
+    -r,     --rate          Messages per second, 0 - as fast as possible (default: 0)
+    -c,     --concurrency   Worker concurrency (default: 1)
+    -p,     --prefetch      Unacknowledged messages in flight (default: concurrency)
+    -e,     --engine        Worker engine: blocking or select (select needs --broker, default: blocking)
+    -o,     --output        Append JSON results to file (default: bench_output.txt)
+            --broker        Use RabbitMQ at host[:port] instead of the in-memory channel
+            --baseline      Compare with results from file, exit with 1 on regression
+            --tolerance     Allowed regression against baseline (default: 0.2)
+''' % ', '.join(SCENARIOS)
+
+
+# Сервер заглушек. Поток на соединение: пул сессий держит несколько соединений открытыми.
+# Разрыв соединения завершившимся сценарием не ошибка
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+# Ответы заглушки JSON-RPC: номер аукциона по номеру лота
+class JsonRpcStub(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    # Ответ одним пакетом: иначе Nagle и отложенный ACK дают 40 мс на запрос
+    wbufsize = -1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        if isinstance(request, list):
+            response = [JsonRpcStub.answer(r) for r in request]
+        else:
+            response = JsonRpcStub.answer(request)
+        self.reply(json.dumps(response), 'application/json')
+
+    def reply(self, body, content_type):
+        self.send_response(200)
+        self.send_header('content-type', content_type)
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+    @staticmethod
+    def answer(request):
+        return {u'jsonrpc': u'2.0', u'id': request.get(u'id'), u'result': {u'госзакупки_id': u'42'}}
+
+
+# Ответы заглушки SOAP на Authorization и BindAuctionToIntegrationPlatform
+class SoapStub(JsonRpcStub):
+
+    ENVELOPE = ('<?xml version="1.0" encoding="utf-8"?>'
+                '<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>%s'
+                '</soap:Body></soap:Envelope>')
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['content-length']))
+        if 'Authorization' in self.headers.get('soapaction', ''):
+            body = ('<AuthorizationResponse xmlns="http://bench/"><AuthorizationResult>'
+                    '<Status>0</Status><Description>ok</Description></AuthorizationResult></AuthorizationResponse>')
+        else:
+            body = '<BindResult xmlns="http://bench/"><Status>0</Status><Description>bound</Description></BindResult>'
+        self.reply(SoapStub.ENVELOPE % body, 'text/xml; charset=utf-8')
+
+
+WSDL = '''<?xml version="1.0" encoding="utf-8"?>
+<wsdl:definitions xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+    xmlns:s="http://www.w3.org/2001/XMLSchema" xmlns:tns="http://bench/" targetNamespace="http://bench/">
+ <wsdl:types><s:schema elementFormDefault="qualified" targetNamespace="http://bench/">
+  <s:complexType name="Result"><s:sequence>
+   <s:element name="Status" type="s:int"/><s:element name="Description" type="s:string"/></s:sequence></s:complexType>
+  <s:element name="Authorization"><s:complexType><s:sequence>
+   <s:element name="identity" type="s:string"/><s:element name="user" type="s:string"/>
+   <s:element name="password" type="s:string"/></s:sequence></s:complexType></s:element>
+  <s:element name="AuthorizationResponse"><s:complexType><s:sequence>
+   <s:element name="AuthorizationResult" type="tns:Result"/></s:sequence></s:complexType></s:element>
+  <s:complexType name="Bind"><s:sequence>
+   <s:element name="uniqueToken" type="s:string"/><s:element name="auctionNumber" type="s:int"/>
+   <s:element name="platformId" type="s:string"/></s:sequence></s:complexType>
+  <s:element name="BindRequest"><s:complexType><s:sequence>
+   <s:element name="request" type="tns:Bind"/></s:sequence></s:complexType></s:element>
+  <s:element name="BindResult" type="tns:Result"/>
+ </s:schema></wsdl:types>
+ <wsdl:message name="AuthorizationIn"><wsdl:part name="parameters" element="tns:Authorization"/></wsdl:message>
+ <wsdl:message name="AuthorizationOut"><wsdl:part name="parameters" element="tns:AuthorizationResponse"/></wsdl:message>
+ <wsdl:message name="BindIn"><wsdl:part name="request" element="tns:BindRequest"/></wsdl:message>
+ <wsdl:message name="BindOut"><wsdl:part name="result" element="tns:BindResult"/></wsdl:message>
+ <wsdl:portType name="Rts">
+  <wsdl:operation name="Authorization"><wsdl:input message="tns:AuthorizationIn"/><wsdl:output message="tns:AuthorizationOut"/></wsdl:operation>
+  <wsdl:operation name="BindAuctionToIntegrationPlatform"><wsdl:input message="tns:BindIn"/><wsdl:output message="tns:BindOut"/></wsdl:operation>
+ </wsdl:portType>
+ <wsdl:binding name="RtsWebServiceSoap" type="tns:Rts"><soap:binding transport="http://schemas.xmlsoap.org/soap/http"/>
+  <wsdl:operation name="Authorization"><soap:operation soapAction="http://bench/Authorization"/>
+   <wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>
+  <wsdl:operation name="BindAuctionToIntegrationPlatform"><soap:operation soapAction="http://bench/Bind"/>
+   <wsdl:input><soap:body use="literal"/></wsdl:input><wsdl:output><soap:body use="literal"/></wsdl:output></wsdl:operation>
+ </wsdl:binding>
+ <wsdl:service name="Rts"><wsdl:port name="RtsWebServiceSoap" binding="tns:RtsWebServiceSoap">
+  <soap:address location="http://127.0.0.1:%d/"/></wsdl:port></wsdl:service>
+</wsdl:definitions>
+'''
+
+# Долгоживущий процесс для exec-persistent: возвращает вход как вывод
+ECHO = '''import sys, json
+for line in iter(sys.stdin.readline, ''):
+    r = json.loads(line)
+    sys.stdout.write(json.dumps({'id': r['id'], 'code': 0, 'output': r.get('input', '')}) + '\\n')
+    sys.stdout.flush()
+'''
+
+
+# Канал RabbitMQ в памяти. Подтверждения передаются в замер
+class FakeChannel(object):
+
+    is_open = True
+
+    def __init__(self, bench):
+        self.bench = bench
+
+    def basic_qos(self, **kwargs):
+        pass
+
+    def basic_consume(self, callback, queue, no_ack=False):
+        self.bench.consumers.append((self, callback, queue))
+        return 'bench'
+
+    def basic_cancel(self, consumer_tag):
+        pass
+
+    def queue_declare(self, **kwargs):
+        return pika.frame.Method(1, pika.spec.Queue.DeclareOk(queue=kwargs.get('queue')))
+
+    def confirm_delivery(self):
+        pass
+
+    def basic_publish(self, **kwargs):
+        self.bench.published += 1
+        return True
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.bench.settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.bench.settle(delivery_tag, multiple, failed=True)
+
+
+# Соединение в памяти: вызовы из потоков пула и таймеры выполняются в process
+class FakeConnection(object):
+
+    is_open = True
+
+    def __init__(self, bench):
+        self.bench = bench
+        self.callbacks = []
+        self.timers = []
+        self.lock = threading.Lock()
+
+    def channel(self):
+        return FakeChannel(self.bench)
+
+    def add_callback_threadsafe(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+
+    def add_timeout(self, deadline, callback):
+        timer = [time.time() + deadline, callback]
+        self.timers.append(timer)
+        return timer
+
+    def remove_timeout(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def close(self):
+        pass
+
+    # Выполнить накопленные вызовы. True, если что-то было выполнено
+    def process(self):
+        with self.lock:
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            callback()
+        now = time.time()
+        due = [t for t in self.timers if t[0] <= now]
+        for timer in due:
+            self.timers.remove(timer)
+            timer[1]()
+        return bool(callbacks or due)
+
+
+# Замер одного сценария в текущем процессе
+class Bench(object):
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.sent = {}        # delivery_tag -> время отправки
+        self.latencies = []
+        self.failed = 0
+        self.published = 0
+        self.consumers = []
+        self.started = None
+        self.finished = None
+
+    def settle(self, tag, multiple, failed=False):
+        now = time.time()
+        tags = [t for t in self.sent if t <= tag] if multiple else [tag]
+        for t in tags:
+            sent = self.sent.pop(t, None)
+            if sent is not None:
+                self.latencies.append(now - sent)
+                if failed:
+                    self.failed += 1
+
+    # Источник RabbitMQ поверх соединения в памяти, сообщения подаются с ограничением prefetch и rate
+    def queue(self):
+        source = RabbitMQCommandSource()
+        CommandSource.init(source)
+        source.connection = FakeConnection(self)
+        source.pools()
+        for route in source.routes:
+            source.open(route)
+        channel, callback, queue = self.consumers[0]
+        n = self.settings['messages']
+        body = 'x' * self.settings['size']
+        window = self.settings['prefetch']
+        rate = self.settings['rate']
+        self.started = time.time()
+        tag = 0
+        while tag < n or self.sent:
+            busy = False
+            if tag < n and len(self.sent) < window and (not rate or time.time() >= self.started + tag / rate):
+                tag += 1
+                self.sent[tag] = time.time()
+                callback(channel, pika.spec.Basic.Deliver(delivery_tag=tag, routing_key=queue, exchange=''),
+                         pika.BasicProperties(), body)
+                busy = True
+            if source.connection.process() or busy:
+                continue
+            time.sleep(0.0002)
+        self.finished = time.time()
+        for route in source.routes:
+            if route.pool is not None:
+                route.pool.stop()
+
+    # Консоль: команды выполняются одна за другой без очереди
+    def console(self):
+        runner = App().registry().get('command_runner')
+        body = 'x' * self.settings['size']
+        rate = self.settings['rate']
+        self.started = time.time()
+        for n in range(self.settings['messages']):
+            if rate:
+                delay = self.started + n / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            sent = time.time()
+            if runner.run(body) != 0:
+                self.failed += 1
+            self.latencies.append(time.time() - sent)
+        self.finished = time.time()
+
+    # Настоящий брокер: сообщения опубликованы заранее, время отправки в заголовке
+    def broker(self):
+        source = App().registry().get('command_source')
+        bench = self
+        n = self.settings['messages']
+        complete = source.complete
+
+        def measured(delivery):
+            complete(delivery)
+            if bench.started is None:
+                bench.started = delivery.received
+            deliveries = delivery.deliveries if isinstance(delivery, rabbitworker.Batch) else [delivery]
+            for d in deliveries:
+                bench.latencies.append(time.time() - float(d.props.headers['x-bench-sent']))
+                if d.result != 0:
+                    bench.failed += 1
+            if len(bench.latencies) >= n:
+                bench.finished = time.time()
+                raise SystemExit(0)
+        source.complete = measured
+        source.init()
+        try:
+            source.run()
+        except SystemExit:
+            pass
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        seconds = (self.finished or time.time()) - (self.started or time.time())
+        return {
+            'scenario': self.settings['scenario'],
+            'engine': self.settings['engine'],
+            'broker': self.settings['broker'],
+            'messages': len(latencies),
+            'failed': self.failed,
+            'size': self.settings['size'],
+            'rate': self.settings['rate'],
+            'concurrency': self.settings['concurrency'],
+            'prefetch': self.settings['prefetch'],
+            'seconds': round(seconds, 3),
+            'msgs_per_sec': round(len(latencies) / seconds, 1) if seconds > 0 else None,
+            'p50_ms': round(Bench.percentile(latencies, 0.5) * 1000, 3),
+            'p99_ms': round(Bench.percentile(latencies, 0.99) * 1000, 3),
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'children_max_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+
+    @staticmethod
+    def percentile(values, q):
+        if not values:
+            return 0.0
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# Сценарии, заглушки и сравнение с базовыми результатами
+class BenchRunner(object):
+
+    def __init__(self, argv):
+        self.argv = argv
+        self.scenarios = list(SCENARIOS)
+        self.settings = {'messages': 2000, 'size': 100, 'rate': 0.0, 'concurrency': 1, 'prefetch': None,
+                         'engine': u'blocking', 'broker': None}
+        self.output = 'bench_output.txt'
+        self.baseline = None
+        self.tolerance = 0.2
+        self.workdir = None
+        self.servers = []
+        self.ports = {}
+
+    def parse(self):
+        try:
+            opts, args = getopt.getopt(self.argv[1:], 'hs:n:b:r:c:p:e:o:',
+                                       ['help', 'scenarios=', 'messages=', 'size=', 'rate=', 'concurrency=',
+                                        'prefetch=', 'engine=', 'output=', 'broker=', 'baseline=', 'tolerance='])
+            for opt, arg in opts:
+                if opt in ('-h', '--help'):
+                    sys.stdout.write(USAGE)
+                    sys.exit(0)
+                elif opt in ('-s', '--scenarios'):
+                    self.scenarios = arg.split(',')
+                elif opt in ('-n', '--messages'):
+                    self.settings['messages'] = int(arg)
+                elif opt in ('-b', '--size'):
+                    self.settings['size'] = int(arg)
+                elif opt in ('-r', '--rate'):
+                    self.settings['rate'] = float(arg)
+                elif opt in ('-c', '--concurrency'):
+                    self.settings['concurrency'] = int(arg)
+                elif opt in ('-p', '--prefetch'):
+                    self.settings['prefetch'] = int(arg)
+                elif opt in ('-e', '--engine'):
+                    self.settings['engine'] = arg
+                elif opt in ('-o', '--output'):
+                    self.output = arg
+                elif opt == '--broker':
+                    self.settings['broker'] = arg
+                elif opt == '--baseline':
+                    self.baseline = arg
+                elif opt == '--tolerance':
+                    self.tolerance = float(arg)
+        except (getopt.GetoptError, ValueError) as e:
+            sys.stderr.write('ERROR: %s\n%s' % (e, USAGE))
+            sys.exit(3)
+        unknown = [s for s in self.scenarios if s not in SCENARIOS]
+        if unknown:
+            sys.stderr.write('ERROR: Unknown scenario(s): %s\n' % ', '.join(unknown))
+            sys.exit(3)
+        if self.settings['prefetch'] is None:
+            self.settings['prefetch'] = self.settings['concurrency']
+        if self.settings['engine'] != u'blocking' and self.settings['broker'] is None:
+            sys.stderr.write('ERROR: The in-memory channel supports only the blocking engine, use --broker\n')
+            sys.exit(3)
+
+    def run(self):
+        self.parse()
+        self.workdir = tempfile.mkdtemp(prefix='rabbitworker-bench-')
+        try:
+            self.serve()
+            results = [self.scenario(name) for name in self.scenarios]
+        finally:
+            for server in self.servers:
+                server.shutdown()
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        with open(self.output, 'a') as fp:
+            for result in results:
+                fp.write(json.dumps(result, sort_keys=True) + '\n')
+        for r in results:
+            if r.get('error'):
+                sys.stdout.write('%-10s failed\n' % r['scenario'])
+                continue
+            sys.stdout.write('%-10s %8s msg/s  p50 %8.3f ms  p99 %8.3f ms  rss %6d KB  failed %d\n' %
+                             (r['scenario'], r['msgs_per_sec'], r['p50_ms'], r['p99_ms'], r['max_rss_kb'], r['failed']))
+        if self.baseline is not None and not self.compare(results):
+            sys.exit(1)
+
+    # Заглушки серверов работают в потоках этого процесса, сценарии - в дочерних
+    def serve(self):
+        for name, handler in (('json-rpc', JsonRpcStub), ('soap', SoapStub)):
+            server = StubServer(('127.0.0.1', 0), handler)
+            self.servers.append(server)
+            thread = threading.Thread(target=server.serve_forever, name=name)
+            thread.daemon = True
+            thread.start()
+            self.ports[name] = server.server_address[1]
+        with open(os.path.join(self.workdir, 'rts.wsdl'), 'w') as fp:
+            fp.write(WSDL % self.ports['soap'])
+        with open(os.path.join(self.workdir, 'echo.py'), 'w') as fp:
+            fp.write(ECHO)
+
+    def config(self, name):
+        rpc = {u'user': u'bench', u'pass': u'bench'}
+        actions = {
+            u'exec': {u'type': u'exec', u'params': {u'exec': u'cat'}},
+            u'persistent': {u'type': u'exec-persistent',
+                            u'params': {u'exec': sys.executable, u'args': [os.path.join(self.workdir, 'echo.py')]}},
+            u'rts': {u'type': u'rts', u'params': {
+                u'json-rpc': dict(rpc, url=u'http://127.0.0.1:%d/' % self.ports['json-rpc']),
+                u'soap': dict(rpc, url=u'file://' + os.path.join(self.workdir, 'rts.wsdl'))}}
+        }
+        actions[u'console'] = actions[u'exec']
+        cfg = {u'queue': u'rabbitworker-bench', u'action': name, u'actions': actions, u'wsdl_cache': False,
+               u'concurrency': self.settings['concurrency'], u'prefetch': self.settings['prefetch'],
+               u'engine': self.settings['engine'], u'replies': False}
+        if self.settings['broker'] is not None:
+            host, _, port = self.settings['broker'].partition(':')
+            cfg[u'host'] = host
+            if port:
+                cfg[u'port'] = int(port)
+        path = os.path.join(self.workdir, '%s.json' % name)
+        with open(path, 'w') as fp:
+            json.dump(cfg, fp)
+        return path
+
+    # Опубликовать сообщения сценария в настоящий брокер
+    def publish(self, host):
+        host, _, port = host.partition(':')
+        connection = pika.BlockingConnection(pika.ConnectionParameters(host=host, port=int(port or 5672)))
+        channel = connection.channel()
+        channel.queue_declare(queue='rabbitworker-bench')
+        channel.queue_purge(queue='rabbitworker-bench')
+        body = 'x' * self.settings['size']
+        for n in range(self.settings['messages']):
+            channel.basic_publish(exchange='', routing_key='rabbitworker-bench', body=body,
+                                  properties=pika.BasicProperties(headers={'x-bench-sent': repr(time.time())}))
+        connection.close()
+
+    # Сценарий выполняется в дочернем процессе: чистые App и замер памяти
+    def scenario(self, name):
+        path = self.config(name)
+        if self.settings['broker'] is not None and name != 'console':
+            self.publish(self.settings['broker'])
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(rfd)
+            code = 0
+            try:
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 1)
+                settings = dict(self.settings, scenario=name)
+                argv = ['rabbitworker', '-c', path, '-l', os.devnull]
+                if name == 'console':
+                    argv.append('-k')
+                sys.argv = argv
+                App().init()
+                bench = Bench(settings)
+                if name == 'console':
+                    bench.console()
+                elif self.settings['broker'] is not None:
+                    bench.broker()
+                else:
+                    bench.queue()
+                os.write(wfd, json.dumps(bench.result()))
+            except BaseException as e:
+                os.write(2, 'ERROR: Scenario %s failed: %r\n' % (name, e))
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(wfd)
+        data = []
+        while True:
+            try:
+                chunk = os.read(rfd, 65536)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if not chunk:
+                break
+            data.append(chunk)
+        os.close(rfd)
+        os.waitpid(pid, 0)
+        if not data:
+            return {'scenario': name, 'error': True, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        return json.loads(''.join(data))
+
+    # Сравнить с последними результатами тех же сценариев из файла baseline
+    def compare(self, results):
+        baseline = {}
+        with open(self.baseline) as fp:
+            for line in fp:
+                if line.strip():
+                    r = json.loads(line)
+                    baseline[(r.get('scenario'), r.get('engine'), r.get('concurrency'), r.get('size'))] = r
+        ok = True
+        for r in results:
+            base = baseline.get((r.get('scenario'), r.get('engine'), r.get('concurrency'), r.get('size')))
+            if r.get('error'):
+                ok = False
+                continue
+            if base is None or base.get('error'):
+                continue
+            if r['msgs_per_sec'] < base['msgs_per_sec'] * (1 - self.tolerance):
+                sys.stdout.write('REGRESSION: %s throughput %s msg/s, baseline %s msg/s\n' %
+                                 (r['scenario'], r['msgs_per_sec'], base['msgs_per_sec']))
+                ok = False
+            if r['p99_ms'] > base['p99_ms'] * (1 + self.tolerance):
+                sys.stdout.write('REGRESSION: %s p99 %.3f ms, baseline %.3f ms\n' %
+                                 (r['scenario'], r['p99_ms'], base['p99_ms']))
+                ok = False
+        return ok
+
+
+if __name__ == '__main__':
+    BenchRunner(sys.argv).run()